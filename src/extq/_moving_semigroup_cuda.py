@@ -0,0 +1,52 @@
+"""CUDA kernels for moving_matmul, imported only when they are used."""
+
+from numba import cuda
+
+
+@cuda.jit
+def moving_matmul_kernel(a, k, temp, out):
+    s = cuda.grid(1)
+    if s >= temp.shape[0]:
+        return
+    acc = temp[s]
+    start = s * (k + 1)
+    end = min(start + k + 1, out.shape[0])
+    for n in range(start, end):
+        j = n - start
+
+        # backward and forward accumulations
+        if j == 0:
+            for jj in range(k - 1, -1, -1):
+                if jj == k - 1:
+                    _copy_cuda(a[n + jj], acc[jj])
+                else:
+                    _mm_cuda(a[n + jj], acc[jj + 1], acc[jj])
+        elif j == 1:
+            _copy_cuda(a[n + k - 1], acc[j - 1])
+        else:
+            _mm_cuda(acc[j - 2], a[n + k - 1], acc[j - 1])
+
+        # combine accumulations
+        if j == 0:
+            _copy_cuda(acc[j], out[n])
+        elif j == k:
+            _copy_cuda(acc[j - 1], out[n])
+        else:
+            _mm_cuda(acc[j], acc[j - 1], out[n])
+
+
+@cuda.jit(device=True)
+def _copy_cuda(a, c):
+    for i in range(c.shape[0]):
+        for j in range(c.shape[1]):
+            c[i, j] = a[i, j]
+
+
+@cuda.jit(device=True)
+def _mm_cuda(a, b, c):
+    for i in range(c.shape[0]):
+        for j in range(c.shape[1]):
+            c_i_j = a[i, 0] * b[0, j]
+            for m in range(1, a.shape[1]):
+                c_i_j += a[i, m] * b[m, j]
+            c[i, j] = c_i_j
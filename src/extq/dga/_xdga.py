@@ -1,4 +1,9 @@
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import numba as nb
 import numpy as np
+import scipy.sparse
 from more_itertools import zip_equal
 
 from .. import linalg
@@ -11,8 +16,18 @@ __all__ = [
     "backward_extended_committor",
     "backward_extended_mfpt",
     "backward_extended_feynman_kac",
+    "forward_extended_transition_products",
+    "backward_extended_transition_products",
 ]
 
+# number of steps of augmented transition matrices processed at a time
+_CHUNK_SIZE = 4096
+
+# size in bytes of the augmented transition matrices of a trajectory
+# below which they are multiplied on the CPU even if device="cuda",
+# since copying them to and from the GPU would cost more than it saves
+_CUDA_MIN_BYTES = 100 * 2**20
+
 
 def forward_extended_committor(
     basis,
@@ -22,6 +37,11 @@ def forward_extended_committor(
     guess,
     lag,
     test_basis=None,
+    compute_dtype=None,
+    device="cpu",
+    n_jobs=None,
+    transition_products=None,
+    validate=True,
 ):
     """Estimate the forward extended committor using DGA.
 
@@ -30,7 +50,8 @@ def forward_extended_committor(
     basis : list of list of (n_frames[i], n_basis) ndarray or sparse matrix of float
         Basis for estimating the extended committor. Must be zero
         outside of the domain. The outer list is over trajectories;
-        the inner list is over indices.
+        the inner list is over indices, and may instead be an
+        (n_indices, n_frames[i], n_basis) ndarray.
     weights : list of (n_frames[i],) ndarray of float
         Change of measure to the invariant distribution for each frame.
     transitions : list of (n_indices, n_indices, n_frames[i]-1) ndarray
@@ -48,6 +69,31 @@ def forward_extended_committor(
         same dimension as the basis used to estimate the extended
         committor. If None, use the basis that is used to estimate the
         extended committor.
+    compute_dtype : dtype, optional
+        Floating point type used to compute products of the transition
+        matrices over the lag time. Using float32 roughly halves the
+        memory traffic and cost of this step, at the price of rounding
+        errors that accumulate over the lag time. The basis and the
+        accumulated DGA matrices are unaffected. If None, use float64.
+    device : {"cpu", "cuda"}, optional
+        Device on which to compute products of the transition matrices
+        over the lag time. If "cuda", the augmented transition matrices
+        of each trajectory are copied to the GPU once and multiplied
+        there. Trajectories whose augmented transition matrices take
+        less than about 100 MB are still handled on the CPU, since the
+        cost of the transfers isn't recovered.
+    n_jobs : int, optional
+        Number of trajectories to process concurrently using threads.
+        If None or 1, process trajectories one at a time, parallelizing
+        the work within each trajectory instead.
+    transition_products : list of (n_indices+1, n_indices+1, n_frames[i]-lag) ndarray, optional
+        Products of the augmented transition matrices over the lag time,
+        as returned by :func:`forward_extended_transition_products` for the
+        same transitions, domain, and guess, a function of 0, and the
+        same lag time. If None, compute them.
+    validate : bool, optional
+        If True (default), check the shapes of the inputs and that the
+        weights of the last `lag` frames of each trajectory are zero.
 
     Returns
     -------
@@ -64,6 +110,11 @@ def forward_extended_committor(
         guess,
         lag,
         test_basis=test_basis,
+        compute_dtype=compute_dtype,
+        device=device,
+        n_jobs=n_jobs,
+        transition_products=transition_products,
+        validate=validate,
     )
 
 
@@ -75,6 +126,11 @@ def forward_extended_mfpt(
     guess,
     lag,
     test_basis=None,
+    compute_dtype=None,
+    device="cpu",
+    n_jobs=None,
+    transition_products=None,
+    validate=True,
 ):
     """Estimate the forward mean first passage time using DGA.
 
@@ -83,7 +139,8 @@ def forward_extended_mfpt(
     basis : list of list of (n_frames[i], n_basis) ndarray or sparse matrix of float
         Basis for estimating the mean first passage time . Must be zero
         outside of the domain. The outer list is over trajectories;
-        the inner list is over indices.
+        the inner list is over indices, and may instead be an
+        (n_indices, n_frames[i], n_basis) ndarray.
     weights : list of (n_frames[i],) ndarray of float
         Change of measure to the invariant distribution for each frame.
     transitions : list of (n_indices, n_indices, n_frames[i]-1) ndarray
@@ -102,6 +159,31 @@ def forward_extended_mfpt(
         same dimension as the basis used to estimate the mean first
         passage time. If None, use the basis that is used to estimate
         the mean first passage time.
+    compute_dtype : dtype, optional
+        Floating point type used to compute products of the transition
+        matrices over the lag time. Using float32 roughly halves the
+        memory traffic and cost of this step, at the price of rounding
+        errors that accumulate over the lag time. The basis and the
+        accumulated DGA matrices are unaffected. If None, use float64.
+    device : {"cpu", "cuda"}, optional
+        Device on which to compute products of the transition matrices
+        over the lag time. If "cuda", the augmented transition matrices
+        of each trajectory are copied to the GPU once and multiplied
+        there. Trajectories whose augmented transition matrices take
+        less than about 100 MB are still handled on the CPU, since the
+        cost of the transfers isn't recovered.
+    n_jobs : int, optional
+        Number of trajectories to process concurrently using threads.
+        If None or 1, process trajectories one at a time, parallelizing
+        the work within each trajectory instead.
+    transition_products : list of (n_indices+1, n_indices+1, n_frames[i]-lag) ndarray, optional
+        Products of the augmented transition matrices over the lag time,
+        as returned by :func:`forward_extended_transition_products` for the
+        same transitions, domain, and guess, a function of 1, and the
+        same lag time. If None, compute them.
+    validate : bool, optional
+        If True (default), check the shapes of the inputs and that the
+        weights of the last `lag` frames of each trajectory are zero.
 
     Returns
     -------
@@ -118,6 +200,11 @@ def forward_extended_mfpt(
         guess,
         lag,
         test_basis=test_basis,
+        compute_dtype=compute_dtype,
+        device=device,
+        n_jobs=n_jobs,
+        transition_products=transition_products,
+        validate=validate,
     )
 
 
@@ -130,6 +217,11 @@ def forward_extended_feynman_kac(
     guess,
     lag,
     test_basis=None,
+    compute_dtype=None,
+    device="cpu",
+    n_jobs=None,
+    transition_products=None,
+    validate=True,
 ):
     """Solve the forward Feynman-Kac formula using DGA.
 
@@ -138,7 +230,8 @@ def forward_extended_feynman_kac(
     basis : list of list of (n_frames[i], n_basis) ndarray or sparse matrix of float
         Basis for estimating the solution to the Feynman-Kac formula.
         Must be zero outside of the domain. The outer list is over
-        trajectories; the inner list is over indices.
+        trajectories; the inner list is over indices, and may instead be
+        an (n_indices, n_frames[i], n_basis) ndarray.
     weights : list of (n_frames[i],) ndarray of float
         Change of measure to the invariant distribution for each frame.
     transitions : list of (n_indices, n_indices, n_frames[i]-1) ndarray
@@ -158,6 +251,32 @@ def forward_extended_feynman_kac(
         Test basis against which to minimize the error. Must have the
         same dimension as the basis used to estimate the solution.
         If None, use the basis that is used to estimate the solution.
+    compute_dtype : dtype, optional
+        Floating point type used to compute products of the transition
+        matrices over the lag time. Using float32 roughly halves the
+        memory traffic and cost of this step, at the price of rounding
+        errors that accumulate over the lag time. The basis and the
+        accumulated DGA matrices are unaffected. If None, use float64.
+    device : {"cpu", "cuda"}, optional
+        Device on which to compute products of the transition matrices
+        over the lag time. If "cuda", the augmented transition matrices
+        of each trajectory are copied to the GPU once and multiplied
+        there. Trajectories whose augmented transition matrices take
+        less than about 100 MB are still handled on the CPU, since the
+        cost of the transfers isn't recovered.
+    n_jobs : int, optional
+        Number of trajectories to process concurrently using threads.
+        If None or 1, process trajectories one at a time, parallelizing
+        the work within each trajectory instead.
+    transition_products : list of (n_indices+1, n_indices+1, n_frames[i]-lag) ndarray, optional
+        Products of the augmented transition matrices over the lag time,
+        as returned by :func:`forward_extended_transition_products` for the
+        same transitions, domain, function, guess, and lag time. This
+        allows them to be reused between estimates that differ only in
+        the basis or test basis. If None, compute them.
+    validate : bool, optional
+        If True (default), check the shapes of the inputs and that the
+        weights of the last `lag` frames of each trajectory are zero.
 
     Returns
     -------
@@ -170,54 +289,50 @@ def forward_extended_feynman_kac(
     if test_basis is None:
         test_basis = basis
     function = _broadcast_integrand(function, transitions)
+    if transition_products is None:
+        transition_products = [None] * len(transitions)
 
     n_indices = None
     n_basis = None
-    a = 0.0
-    b = 0.0
-    for x, y, w, k, d, f, g in zip_equal(
-        test_basis, basis, weights, transitions, in_domain, function, guess
+    trajs = []
+    for x, y, w, k, d, f, g, m in zip_equal(
+        test_basis,
+        basis,
+        weights,
+        transitions,
+        in_domain,
+        function,
+        guess,
+        transition_products,
     ):
         n_frames = x[0].shape[0]
         n_indices = len(x) if n_indices is None else n_indices
         n_basis = x[0].shape[1] if n_basis is None else n_basis
 
-        assert len(x) == n_indices
-        assert (xi.shape == (n_frames, n_basis) for xi in x)
-        assert len(y) == n_indices
-        assert (yi.shape == (n_frames, n_basis) for yi in y)
-        assert w.shape == (n_frames,)
-        assert k.shape == (n_indices, n_indices, n_frames - 1)
-        assert d.shape == (n_indices, n_frames)
-        assert f.shape == (n_indices, n_indices, n_frames - 1)
-        assert g.shape == (n_indices, n_frames)
+        if validate:
+            assert len(x) == n_indices
+            assert all(xi.shape == (n_frames, n_basis) for xi in x)
+            assert len(y) == n_indices
+            assert all(yi.shape == (n_frames, n_basis) for yi in y)
+            assert w.shape == (n_frames,)
+            assert k.shape == (n_indices, n_indices, n_frames - 1)
+            assert d.shape == (n_indices, n_frames)
+            assert np.ndim(f) == 0 or f.shape == k.shape
+            assert g.shape == (n_indices, n_frames)
+            assert not w[max(0, n_frames - lag) :].any()
+            if m is not None and n_frames > lag:
+                shape = (n_indices + 1, n_indices + 1, n_frames - lag)
+                assert m.shape == shape
 
-        assert np.all(w[max(0, n_frames - lag) :] == 0.0)
         if n_frames <= lag:
             continue
+        trajs.append((x, y, w, k, d, f, g, m))
 
-        m = np.zeros((n_indices + 1, n_indices + 1, n_frames - 1))
-        m[:-1, :-1] = np.where(d[:, None, :-1], k, 0)
-        m[:-1, -1] = np.where(d[:, :-1], np.sum(k * f, axis=1), g[:, :-1])
-        m[-1, -1] = 1
-        m = np.moveaxis(moving_matmul(np.moveaxis(m, -1, 0), lag), 0, -1)
-
-        for i in range(n_indices):
-            wx = linalg.scale_rows(w[:-lag], x[i][:-lag])
-
-            yi = 0.0
-            gi = 0.0
-
-            for j in range(n_indices):
-                yi += linalg.scale_rows(m[i, j], y[j][lag:])
-                gi += linalg.scale_rows(m[i, j], g[j][lag:])
-            gi += m[i, -1]  # integral and boundary conditions
-
-            yi -= y[i][:-lag]
-            gi -= g[i][:-lag]
-
-            a += wx.T @ yi
-            b -= wx.T @ gi
+    a = np.zeros((n_basis, n_basis))
+    b = np.zeros(n_basis)
+    _add_trajectories(
+        a, b, _forward_matrices, trajs, lag, compute_dtype, device, n_jobs
+    )
 
     coeffs = linalg.solve(a, b)
     return transform(coeffs, basis, guess)
@@ -231,6 +346,11 @@ def backward_extended_committor(
     guess,
     lag,
     test_basis=None,
+    compute_dtype=None,
+    device="cpu",
+    n_jobs=None,
+    transition_products=None,
+    validate=True,
 ):
     """Estimate the backward extended committor using DGA.
 
@@ -239,7 +359,8 @@ def backward_extended_committor(
     basis : list of list of (n_frames[i], n_basis) ndarray or sparse matrix of float
         Basis for estimating the extended committor. Must be zero
         outside of the domain. The outer list is over trajectories;
-        the inner list is over indices.
+        the inner list is over indices, and may instead be an
+        (n_indices, n_frames[i], n_basis) ndarray.
     weights : list of (n_frames[i],) ndarray of float
         Change of measure to the invariant distribution for each frame.
     transitions : list of (n_indices, n_indices, n_frames[i]-1) ndarray
@@ -257,6 +378,31 @@ def backward_extended_committor(
         same dimension as the basis used to estimate the extended
         committor. If None, use the basis that is used to estimate the
         extended committor.
+    compute_dtype : dtype, optional
+        Floating point type used to compute products of the transition
+        matrices over the lag time. Using float32 roughly halves the
+        memory traffic and cost of this step, at the price of rounding
+        errors that accumulate over the lag time. The basis and the
+        accumulated DGA matrices are unaffected. If None, use float64.
+    device : {"cpu", "cuda"}, optional
+        Device on which to compute products of the transition matrices
+        over the lag time. If "cuda", the augmented transition matrices
+        of each trajectory are copied to the GPU once and multiplied
+        there. Trajectories whose augmented transition matrices take
+        less than about 100 MB are still handled on the CPU, since the
+        cost of the transfers isn't recovered.
+    n_jobs : int, optional
+        Number of trajectories to process concurrently using threads.
+        If None or 1, process trajectories one at a time, parallelizing
+        the work within each trajectory instead.
+    transition_products : list of (n_indices+1, n_indices+1, n_frames[i]-lag) ndarray, optional
+        Products of the augmented transition matrices over the lag time,
+        as returned by :func:`backward_extended_transition_products` for the
+        same transitions, domain, and guess, a function of 0, and the
+        same lag time. If None, compute them.
+    validate : bool, optional
+        If True (default), check the shapes of the inputs and that the
+        weights of the last `lag` frames of each trajectory are zero.
 
     Returns
     -------
@@ -273,6 +419,11 @@ def backward_extended_committor(
         guess,
         lag,
         test_basis=test_basis,
+        compute_dtype=compute_dtype,
+        device=device,
+        n_jobs=n_jobs,
+        transition_products=transition_products,
+        validate=validate,
     )
 
 
@@ -284,6 +435,11 @@ def backward_extended_mfpt(
     guess,
     lag,
     test_basis=None,
+    compute_dtype=None,
+    device="cpu",
+    n_jobs=None,
+    transition_products=None,
+    validate=True,
 ):
     """Estimate the backward mean first passage time using DGA.
 
@@ -292,7 +448,8 @@ def backward_extended_mfpt(
     basis : list of list of (n_frames[i], n_basis) ndarray or sparse matrix of float
         Basis for estimating the mean first passage time . Must be zero
         outside of the domain. The outer list is over trajectories;
-        the inner list is over indices.
+        the inner list is over indices, and may instead be an
+        (n_indices, n_frames[i], n_basis) ndarray.
     weights : list of (n_frames[i],) ndarray of float
         Change of measure to the invariant distribution for each frame.
     transitions : list of (n_indices, n_indices, n_frames[i]-1) ndarray
@@ -311,6 +468,31 @@ def backward_extended_mfpt(
         same dimension as the basis used to estimate the mean first
         passage time. If None, use the basis that is used to estimate
         the mean first passage time.
+    compute_dtype : dtype, optional
+        Floating point type used to compute products of the transition
+        matrices over the lag time. Using float32 roughly halves the
+        memory traffic and cost of this step, at the price of rounding
+        errors that accumulate over the lag time. The basis and the
+        accumulated DGA matrices are unaffected. If None, use float64.
+    device : {"cpu", "cuda"}, optional
+        Device on which to compute products of the transition matrices
+        over the lag time. If "cuda", the augmented transition matrices
+        of each trajectory are copied to the GPU once and multiplied
+        there. Trajectories whose augmented transition matrices take
+        less than about 100 MB are still handled on the CPU, since the
+        cost of the transfers isn't recovered.
+    n_jobs : int, optional
+        Number of trajectories to process concurrently using threads.
+        If None or 1, process trajectories one at a time, parallelizing
+        the work within each trajectory instead.
+    transition_products : list of (n_indices+1, n_indices+1, n_frames[i]-lag) ndarray, optional
+        Products of the augmented transition matrices over the lag time,
+        as returned by :func:`backward_extended_transition_products` for the
+        same transitions, domain, and guess, a function of 1, and the
+        same lag time. If None, compute them.
+    validate : bool, optional
+        If True (default), check the shapes of the inputs and that the
+        weights of the last `lag` frames of each trajectory are zero.
 
     Returns
     -------
@@ -327,6 +509,11 @@ def backward_extended_mfpt(
         guess,
         lag,
         test_basis=test_basis,
+        compute_dtype=compute_dtype,
+        device=device,
+        n_jobs=n_jobs,
+        transition_products=transition_products,
+        validate=validate,
     )
 
 
@@ -339,6 +526,11 @@ def backward_extended_feynman_kac(
     guess,
     lag,
     test_basis=None,
+    compute_dtype=None,
+    device="cpu",
+    n_jobs=None,
+    transition_products=None,
+    validate=True,
 ):
     """Solve the backward Feynman-Kac formula using DGA.
 
@@ -347,7 +539,8 @@ def backward_extended_feynman_kac(
     basis : list of list of (n_frames[i], n_basis) ndarray or sparse matrix of float
         Basis for estimating the solution to the Feynman-Kac formula.
         Must be zero outside of the domain. The outer list is over
-        trajectories; the inner list is over indices.
+        trajectories; the inner list is over indices, and may instead be
+        an (n_indices, n_frames[i], n_basis) ndarray.
     weights : list of (n_frames[i],) ndarray of float
         Change of measure to the invariant distribution for each frame.
     transitions : list of (n_indices, n_indices, n_frames[i]-1) ndarray
@@ -367,6 +560,32 @@ def backward_extended_feynman_kac(
         Test basis against which to minimize the error. Must have the
         same dimension as the basis used to estimate the solution.
         If None, use the basis that is used to estimate the solution.
+    compute_dtype : dtype, optional
+        Floating point type used to compute products of the transition
+        matrices over the lag time. Using float32 roughly halves the
+        memory traffic and cost of this step, at the price of rounding
+        errors that accumulate over the lag time. The basis and the
+        accumulated DGA matrices are unaffected. If None, use float64.
+    device : {"cpu", "cuda"}, optional
+        Device on which to compute products of the transition matrices
+        over the lag time. If "cuda", the augmented transition matrices
+        of each trajectory are copied to the GPU once and multiplied
+        there. Trajectories whose augmented transition matrices take
+        less than about 100 MB are still handled on the CPU, since the
+        cost of the transfers isn't recovered.
+    n_jobs : int, optional
+        Number of trajectories to process concurrently using threads.
+        If None or 1, process trajectories one at a time, parallelizing
+        the work within each trajectory instead.
+    transition_products : list of (n_indices+1, n_indices+1, n_frames[i]-lag) ndarray, optional
+        Products of the augmented transition matrices over the lag time,
+        as returned by :func:`backward_extended_transition_products` for the
+        same transitions, domain, function, guess, and lag time. This
+        allows them to be reused between estimates that differ only in
+        the basis or test basis. If None, compute them.
+    validate : bool, optional
+        If True (default), check the shapes of the inputs and that the
+        weights of the last `lag` frames of each trajectory are zero.
 
     Returns
     -------
@@ -379,67 +598,570 @@ def backward_extended_feynman_kac(
     if test_basis is None:
         test_basis = basis
     function = _broadcast_integrand(function, transitions)
+    if transition_products is None:
+        transition_products = [None] * len(transitions)
 
     n_indices = None
     n_basis = None
-    a = 0.0
-    b = 0.0
-    for x, y, w, k, d, f, g in zip_equal(
-        test_basis, basis, weights, transitions, in_domain, function, guess
+    trajs = []
+    for x, y, w, k, d, f, g, m in zip_equal(
+        test_basis,
+        basis,
+        weights,
+        transitions,
+        in_domain,
+        function,
+        guess,
+        transition_products,
     ):
         n_frames = x[0].shape[0]
         n_indices = len(x) if n_indices is None else n_indices
         n_basis = x[0].shape[1] if n_basis is None else n_basis
 
-        assert len(x) == n_indices
-        assert (xi.shape == (n_frames, n_basis) for xi in x)
-        assert len(y) == n_indices
-        assert (yi.shape == (n_frames, n_basis) for yi in y)
-        assert w.shape == (n_frames,)
-        assert k.shape == (n_indices, n_indices, n_frames - 1)
-        assert d.shape == (n_indices, n_frames)
-        assert f.shape == (n_indices, n_indices, n_frames - 1)
-        assert g.shape == (n_indices, n_frames)
+        if validate:
+            assert len(x) == n_indices
+            assert all(xi.shape == (n_frames, n_basis) for xi in x)
+            assert len(y) == n_indices
+            assert all(yi.shape == (n_frames, n_basis) for yi in y)
+            assert w.shape == (n_frames,)
+            assert k.shape == (n_indices, n_indices, n_frames - 1)
+            assert d.shape == (n_indices, n_frames)
+            assert np.ndim(f) == 0 or f.shape == k.shape
+            assert g.shape == (n_indices, n_frames)
+            assert not w[max(0, n_frames - lag) :].any()
+            if m is not None and n_frames > lag:
+                shape = (n_indices + 1, n_indices + 1, n_frames - lag)
+                assert m.shape == shape
 
-        assert np.all(w[max(0, n_frames - lag) :] == 0.0)
         if n_frames <= lag:
             continue
+        trajs.append((x, y, w, k, d, f, g, m))
 
-        m = np.zeros((n_indices + 1, n_indices + 1, n_frames - 1))
-        m[:-1, :-1] = np.where(d[None, :, 1:], k, 0)
-        m[-1, :-1] = np.where(d[:, 1:], np.sum(k * f, axis=0), g[:, 1:])
-        m[-1, -1] = 1
-        m = np.moveaxis(moving_matmul(np.moveaxis(m, -1, 0), lag), 0, -1)
+    a = np.zeros((n_basis, n_basis))
+    b = np.zeros(n_basis)
+    _add_trajectories(
+        a, b, _backward_matrices, trajs, lag, compute_dtype, device, n_jobs
+    )
 
-        for i in range(n_indices):
-            wx = linalg.scale_rows(w[:-lag], x[i][lag:])
+    coeffs = linalg.solve(a, b)
+    return transform(coeffs, basis, guess)
 
-            yi = 0.0
-            gi = 0.0
 
-            for j in range(n_indices):
-                yi += linalg.scale_rows(m[j, i], y[j][:-lag])
-                gi += linalg.scale_rows(m[j, i], g[j][:-lag])
-            gi += m[-1, i]  # integral and boundary conditions
+def forward_extended_transition_products(
+    transitions,
+    in_domain,
+    function,
+    guess,
+    lag,
+    compute_dtype=None,
+    device="cpu",
+):
+    """Compute products of the forward augmented transition matrices
+    over the lag time.
 
-            yi -= y[i][lag:]
-            gi -= g[i][lag:]
+    These are independent of the basis, so they can be computed once
+    and passed to :func:`forward_extended_feynman_kac` (or the extended
+    committor and mean first passage time, with a `function` of 0 or
+    1) for several choices of basis and test basis.
 
-            a += wx.T @ yi
-            b -= wx.T @ gi
+    Parameters
+    ----------
+    transitions : list of (n_indices, n_indices, n_frames[i]-1) ndarray
+        Possible transitions of the index process between adjacent
+        frames.
+    in_domain : list of (n_indices, n_frames[i]) ndarray of bool
+        For each value of the index process, whether each frame of the
+        trajectories is in the domain.
+    function : list of (n_indices, n_frames[i]-1) ndarray of float
+        Function to integrate. Note that this is defined over
+        transitions, not frames.
+    guess : list of (n_indices, n_frames[i]) ndarray of float
+        Guess for the solution. Must obey boundary conditions.
+    lag : int
+        DGA lag time in units of frames.
+    compute_dtype : dtype, optional
+        Floating point type used to compute the products. If None, use
+        float64.
+    device : {"cpu", "cuda"}, optional
+        Device on which to compute the products. If "cuda", the
+        augmented transition matrices of each trajectory are copied to
+        the GPU once and multiplied there. Trajectories whose augmented
+        transition matrices take less than about 100 MB are still
+        handled on the CPU, since the cost of the transfers isn't
+        recovered.
 
-    coeffs = linalg.solve(a, b)
-    return transform(coeffs, basis, guess)
+    Returns
+    -------
+    list of (n_indices+1, n_indices+1, n_frames[i]-lag) ndarray
+        Products of the augmented transition matrices starting at each
+        frame. Trajectories no longer than the lag time yield empty
+        arrays.
+
+    """
+    return _transition_products(
+        _forward_transitions,
+        transitions,
+        in_domain,
+        function,
+        guess,
+        lag,
+        compute_dtype,
+        device,
+    )
+
+
+def backward_extended_transition_products(
+    transitions,
+    in_domain,
+    function,
+    guess,
+    lag,
+    compute_dtype=None,
+    device="cpu",
+):
+    """Compute products of the backward augmented transition matrices
+    over the lag time.
+
+    These are independent of the basis, so they can be computed once
+    and passed to :func:`backward_extended_feynman_kac` (or the extended
+    committor and mean first passage time, with a `function` of 0 or
+    1) for several choices of basis and test basis.
+
+    Parameters
+    ----------
+    transitions : list of (n_indices, n_indices, n_frames[i]-1) ndarray
+        Possible transitions of the index process between adjacent
+        frames.
+    in_domain : list of (n_indices, n_frames[i]) ndarray of bool
+        For each value of the index process, whether each frame of the
+        trajectories is in the domain.
+    function : list of (n_indices, n_frames[i]-1) ndarray of float
+        Function to integrate. Note that this is defined over
+        transitions, not frames.
+    guess : list of (n_indices, n_frames[i]) ndarray of float
+        Guess for the solution. Must obey boundary conditions.
+    lag : int
+        DGA lag time in units of frames.
+    compute_dtype : dtype, optional
+        Floating point type used to compute the products. If None, use
+        float64.
+    device : {"cpu", "cuda"}, optional
+        Device on which to compute the products. If "cuda", the
+        augmented transition matrices of each trajectory are copied to
+        the GPU once and multiplied there. Trajectories whose augmented
+        transition matrices take less than about 100 MB are still
+        handled on the CPU, since the cost of the transfers isn't
+        recovered.
+
+    Returns
+    -------
+    list of (n_indices+1, n_indices+1, n_frames[i]-lag) ndarray
+        Products of the augmented transition matrices ending at each
+        frame. Trajectories no longer than the lag time yield empty
+        arrays.
+
+    """
+    return _transition_products(
+        _backward_transitions,
+        transitions,
+        in_domain,
+        function,
+        guess,
+        lag,
+        compute_dtype,
+        device,
+    )
 
 
 def transform(coeffs, basis, guess):
+    out = []
+    for y, g in zip_equal(basis, guess):
+        if isinstance(y, np.ndarray):
+            out.append(np.tensordot(y, coeffs, axes=1) + g)
+        else:
+            out.append(
+                np.array([yi @ coeffs + gi for yi, gi in zip_equal(y, g)])
+            )
+    return out
+
+
+def _add_trajectories(a, b, func, trajs, lag, dtype, device, n_jobs):
+    """Add the DGA matrices of each trajectory to `a` and `b`.
+
+    With multiple jobs, trajectories are distributed over a thread pool
+    and the compiled kernels within each trajectory run serially, which
+    keeps the kernels from launching parallel regions from several
+    threads at once. The kernels release the GIL, so the threads run
+    concurrently.
+
+    """
+    if n_jobs is None or n_jobs == 1 or len(trajs) <= 1:
+        _add_matrices(a, b, func, trajs, lag, dtype, device, True)
+        return
+    n_jobs = min(n_jobs, len(trajs))
+
+    # each thread sums its share of the trajectories into its own
+    # matrices, so that at most one trajectory per thread is held in
+    # memory at a time
+    def add(job):
+        a_job = np.zeros_like(a)
+        b_job = np.zeros_like(b)
+        _add_matrices(
+            a_job, b_job, func, trajs[job::n_jobs], lag, dtype, device, False
+        )
+        return a_job, b_job
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        for a_job, b_job in executor.map(add, range(n_jobs)):
+            a += a_job
+            b += b_job
+
+
+def _add_matrices(a, b, func, trajs, lag, dtype, device, parallel):
+    for traj in trajs:
+        a_traj, b_traj = func(*traj, lag, dtype, device, parallel)
+        a += a_traj
+        b += b_traj
+
+
+def _forward_matrices(x, y, w, k, d, f, g, m, lag, dtype, device, parallel):
+    """Contributions of a trajectory to the forward DGA matrices."""
+    n_indices = len(x)
+    if m is None:
+        m = _forward_transitions(k, d, f, g, lag, dtype, device, parallel)
+
+    x, y = _pack_index_bases(x, y)
+    yi = _transform_basis(
+        m[:-1, :-1], _index_frames(y, slice(lag, None)), parallel
+    )
+    gi = np.einsum("ijt,jt->it", m[:-1, :-1], g[:, lag:], order="C")
+    gi += m[:-1, -1]  # integral and boundary conditions
+    gi -= g[:, :-lag]
+    for i in range(n_indices):
+        yi[i] -= y[i][:-lag]
+
+    a, b = _index_inner(w[:-lag], x, slice(None, -lag), yi, gi)
+    return a, -b
+
+
+def _backward_matrices(x, y, w, k, d, f, g, m, lag, dtype, device, parallel):
+    """Contributions of a trajectory to the backward DGA matrices."""
+    n_indices = len(x)
+    if m is None:
+        m = _backward_transitions(k, d, f, g, lag, dtype, device, parallel)
+
+    x, y = _pack_index_bases(x, y)
+    mt = np.swapaxes(m[:-1, :-1], 0, 1)
+    yi = _transform_basis(mt, _index_frames(y, slice(None, -lag)), parallel)
+    gi = np.einsum("ijt,jt->it", mt, g[:, :-lag], order="C")
+    gi += m[-1, :-1]  # integral and boundary conditions
+    gi -= g[:, lag:]
+    for i in range(n_indices):
+        yi[i] -= y[i][lag:]
+
+    a, b = _index_inner(w[:-lag], x, slice(lag, None), yi, gi)
+    return a, -b
+
+
+def _pack_index_basis(y):
+    """Pack a basis over indices into a single array, if possible.
+
+    Returns an (n_indices, n_frames, n_basis) ndarray if every element
+    of `y` is a dense array with the same shape and dtype. Otherwise,
+    `y` is returned unchanged.
+
+    """
+    if isinstance(y, np.ndarray):
+        return y
+    if any(scipy.sparse.issparse(yj) for yj in y):
+        return y
+    if len({(yj.shape, yj.dtype) for yj in y}) != 1:
+        return y
+    return np.stack(y)
+
+
+def _pack_index_bases(x, y):
+    """Pack a test basis and a basis, sharing the result if they are
+    the same object."""
+    if x is y:
+        x = y = _pack_index_basis(y)
+    else:
+        x = _pack_index_basis(x)
+        y = _pack_index_basis(y)
+    return x, y
+
+
+def _index_frames(y, frames):
+    """Select frames from each element of a basis over indices."""
+    if isinstance(y, np.ndarray):
+        return y[:, frames]
+    return [yj[frames] for yj in y]
+
+
+def _transform_basis(m, y, parallel=True):
+    """Apply transition matrices to a basis over indices.
+
+    Computes ``out[i] = sum(scale_rows(m[i, j], y[j]) for j)``. Packed
+    bases are contracted in a single pass by a compiled kernel;
+    otherwise, the elements of the basis are summed one index at a time.
+
+    """
+    if isinstance(y, np.ndarray):
+        out = np.empty(m.shape[:1] + y.shape[1:], dtype=np.result_type(m, y))
+        if parallel:
+            _transform_basis_kernel_parallel(m, y, out)
+        else:
+            _transform_basis_kernel(m, y, out)
+        return out
     return [
-        np.array([yi @ coeffs + gi for yi, gi in zip_equal(y, g)])
-        for y, g in zip_equal(basis, guess)
+        sum(linalg.scale_rows(mij, yj) for mij, yj in zip_equal(mi, y))
+        for mi in m
     ]
 
 
+def _transform_basis_impl(m, y, out):
+    n_out, n_in, n_frames = m.shape
+    n_basis = y.shape[-1]
+    for t in nb.prange(n_frames):
+        for i in range(n_out):
+            for k in range(n_basis):
+                out[i, t, k] = 0.0
+            for j in range(n_in):
+                mij = m[i, j, t]
+                for k in range(n_basis):
+                    out[i, t, k] += mij * y[j, t, k]
+
+
+_transform_basis_kernel = nb.njit(nogil=True, fastmath=True)(
+    _transform_basis_impl
+)
+_transform_basis_kernel_parallel = nb.njit(
+    parallel=True, nogil=True, fastmath=True
+)(_transform_basis_impl)
+
+
+def _index_inner(w, x, frames, y, g):
+    """Contract a weighted test basis with a basis and a guess.
+
+    Computes ``sum(scale_rows(w, x[i][frames]).T @ y[i] for i)`` and the
+    same sum with `g` in place of `y`. Packed arrays are flattened over
+    indices and frames and contracted in a single matrix product.
+
+    """
+    if isinstance(x, np.ndarray) and isinstance(y, np.ndarray):
+        wx = w[:, None] * x[:, frames]
+        wx = wx.reshape((-1, wx.shape[-1]))
+        return wx.T @ y.reshape((-1,) + y.shape[2:]), wx.T @ g.reshape(-1)
+    a = 0.0
+    b = 0.0
+    for xi, yi, gi in zip_equal(x, y, g):
+        ai, bi = _weighted_inner(w, xi, frames, yi, gi)
+        a += ai
+        b += bi
+    return a, b
+
+
+def _weighted_inner(w, x, frames, y, g):
+    """Computes ``scale_rows(w, x[frames]).T @ y`` and the same product
+    with `g` in place of `y`.
+
+    A sparse test basis is converted to CSR (once per trajectory, and
+    free if it is already CSR) and contracted by a compiled kernel in a
+    single pass over its nonzero entries, reading the rows in place
+    instead of slicing and scaling a copy of the matrix.
+
+    """
+    if scipy.sparse.issparse(x):
+        x = x.tocsr()
+    if scipy.sparse.issparse(x) and isinstance(y, np.ndarray):
+        start = frames.indices(x.shape[0])[0]
+        a = np.zeros(
+            (x.shape[1], y.shape[1]), dtype=np.result_type(w, x.dtype, y)
+        )
+        b = np.zeros(x.shape[1], dtype=np.result_type(w, x.dtype, g))
+        _csr_inner_kernel(x.indptr, x.indices, x.data, start, w, y, g, a, b)
+        return a, b
+    wx = linalg.scale_rows(w, x[frames])
+    a = wx.T @ y
+    if scipy.sparse.issparse(a):
+        a = a.toarray()
+    return a, wx.T @ g
+
+
+@nb.njit(nogil=True, fastmath=True)
+def _csr_inner_kernel(indptr, indices, data, start, w, y, g, a, b):
+    n_basis = y.shape[1]
+    for t in range(len(w)):
+        for p in range(indptr[start + t], indptr[start + t + 1]):
+            i = indices[p]
+            c = w[t] * data[p]
+            b[i] += c * g[t]
+            for k in range(n_basis):
+                a[i, k] += c * y[t, k]
+
+
+def _transition_products(
+    func, transitions, in_domain, function, guess, lag, dtype, device
+):
+    assert lag > 0
+    function = _broadcast_integrand(function, transitions)
+    out = []
+    for k, d, f, g in zip_equal(transitions, in_domain, function, guess):
+        n_indices = k.shape[0]
+        n_frames = k.shape[-1] + 1
+
+        assert k.shape == (n_indices, n_indices, n_frames - 1)
+        assert d.shape == (n_indices, n_frames)
+        assert np.ndim(f) == 0 or f.shape == k.shape
+        assert g.shape == (n_indices, n_frames)
+
+        if n_frames <= lag:
+            shape = (n_indices + 1, n_indices + 1, 0)
+            out.append(np.empty(shape, dtype=dtype))
+        else:
+            out.append(func(k, d, f, g, lag, dtype, device))
+    return out
+
+
+def _forward_transitions(
+    k, d, f, g, lag, dtype=None, device="cpu", parallel=True
+):
+    """Moving products of the forward augmented transition matrices.
+
+    Returns an (n_indices + 1, n_indices + 1, n_frames - lag) array.
+
+    """
+    return _moving_transitions(
+        _forward_transitions_helper, k, d, f, g, lag, dtype, device, parallel
+    )
+
+
+def _backward_transitions(
+    k, d, f, g, lag, dtype=None, device="cpu", parallel=True
+):
+    """Moving products of the backward augmented transition matrices.
+
+    Returns an (n_indices + 1, n_indices + 1, n_frames - lag) array.
+
+    """
+    return _moving_transitions(
+        _backward_transitions_helper, k, d, f, g, lag, dtype, device, parallel
+    )
+
+
+def _moving_transitions(helper, k, d, f, g, lag, dtype, device, parallel):
+    assert device in ("cpu", "cuda")
+    n_indices = k.shape[0]
+    n_steps = k.shape[-1]
+    n_out = n_steps - lag + 1
+    m = np.empty((n_steps, n_indices + 1, n_indices + 1), dtype=dtype)
+
+    if device == "cuda" and m.nbytes >= _CUDA_MIN_BYTES:
+        # copy the whole trajectory to the GPU at once
+        helper(k, d, f, g, m)
+        moving_matmul(m, lag, device="cuda")
+        return np.ascontiguousarray(m[:n_out].transpose(1, 2, 0))
+
+    # Build the augmented transition matrices and take their moving
+    # products one chunk of steps at a time, so that each chunk is still
+    # in cache when it is multiplied. moving_matmul only overwrites the
+    # leading output rows of its input, which later chunks don't read.
+    chunk = max(_CHUNK_SIZE, 8 * lag)
+    built = 0
+    for start in range(0, n_out, chunk):
+        stop = min(start + chunk + lag - 1, n_steps)
+        helper(
+            k[..., built:stop],
+            d[:, built : stop + 1],
+            f if np.ndim(f) == 0 else f[..., built:stop],
+            g[:, built : stop + 1],
+            m[built:stop],
+        )
+        built = stop
+        moving_matmul(m[start:stop], lag, parallel=parallel)
+    return np.ascontiguousarray(m[:n_out].transpose(1, 2, 0))
+
+
+def _forward_transitions_helper(k, d, f, g, out):
+    """Augmented transition matrices for the forward problem.
+
+    The output is time-major, as required by :func:`moving_matmul`.
+
+    """
+    integrate = np.ndim(f) != 0 or f != 0.0
+    kernel = _forward_transitions_kernel(k.shape[0], integrate)
+    kernel(k, d, np.broadcast_to(f, k.shape), g, out)
+
+
+def _backward_transitions_helper(k, d, f, g, out):
+    """Augmented transition matrices for the backward problem.
+
+    The output is time-major, as required by :func:`moving_matmul`.
+
+    """
+    integrate = np.ndim(f) != 0 or f != 0.0
+    kernel = _backward_transitions_kernel(k.shape[0], integrate)
+    kernel(k, d, np.broadcast_to(f, k.shape), g, out)
+
+
+# The kernels below are compiled separately for each number of indices,
+# which Numba treats as a compile-time constant. This lets the loops over
+# indices be fully unrolled, which is much faster for a few indices.
+# Separate kernels are also compiled for a zero integrand (committors),
+# which skip the integral altogether.
+
+
+@functools.lru_cache(maxsize=None)
+def _forward_transitions_kernel(n_indices, integrate):
+    @nb.njit(nogil=True, fastmath=True)
+    def kernel(k, d, f, g, out):
+        for t in range(out.shape[0]):
+            for i in range(n_indices):
+                if d[i, t]:
+                    integral = 0.0
+                    for j in range(n_indices):
+                        out[t, i, j] = k[i, j, t]
+                        if integrate:
+                            integral += k[i, j, t] * f[i, j, t]
+                    out[t, i, n_indices] = integral
+                else:
+                    for j in range(n_indices):
+                        out[t, i, j] = 0.0
+                    out[t, i, n_indices] = g[i, t]
+            for j in range(n_indices):
+                out[t, n_indices, j] = 0.0
+            out[t, n_indices, n_indices] = 1.0
+
+    return kernel
+
+
+@functools.lru_cache(maxsize=None)
+def _backward_transitions_kernel(n_indices, integrate):
+    @nb.njit(nogil=True, fastmath=True)
+    def kernel(k, d, f, g, out):
+        for t in range(out.shape[0]):
+            for j in range(n_indices):
+                out[t, n_indices, j] = 0.0
+            for i in range(n_indices):
+                for j in range(n_indices):
+                    if d[j, t + 1]:
+                        out[t, i, j] = k[i, j, t]
+                        if integrate:
+                            out[t, n_indices, j] += k[i, j, t] * f[i, j, t]
+                    else:
+                        out[t, i, j] = 0.0
+                out[t, i, n_indices] = 0.0
+            for j in range(n_indices):
+                if not d[j, t + 1]:
+                    out[t, n_indices, j] = g[j, t + 1]
+            out[t, n_indices, n_indices] = 1.0
+
+    return kernel
+
+
 def _broadcast_integrand(f, transitions):
+    # constant integrands are kept as scalars, and broadcast to the
+    # shape of the transitions without copying
     if not np.iterable(f):
-        f = [np.broadcast_to(f, m.shape) for m in transitions]
+        f = [f] * len(transitions)
     return f
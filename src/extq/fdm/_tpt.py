@@ -201,8 +201,9 @@ def reweight(generator):
     mask = np.full(generator.shape[0], True)
     mask[fixed_index] = False
 
-    a = generator.T[mask, :][:, mask]
-    b = -generator.T[mask, fixed_index]
+    # slice before transposing, so that only the submatrix is transposed
+    a = generator[mask][:, mask].T
+    b = -generator[fixed_index, mask].T
     coeffs = scipy.sparse.linalg.spsolve(a, b)
 
     weights = np.empty(generator.shape[0])
@@ -1,6 +1,10 @@
 """DGA with memory estimators for statistics."""
 
+import contextlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
+import numba as nb
 import numpy as np
 from more_itertools import zip_equal
 
@@ -27,6 +31,10 @@ __all__ = [
     "solve",
 ]
 
+# fraction of frames in the domain below which the memory terms of the
+# Feynman-Kac problems are evaluated only at frames in the domain
+_GATHER_FRACTION = 0.75
+
 
 def reweight(
     basis,
@@ -38,6 +46,10 @@ def reweight(
     return_solution=True,
     return_coef=False,
     return_mem_coef=False,
+    matrices=None,
+    n_jobs=None,
+    compute_dtype=None,
+    device="cpu",
 ):
     """
     Estimate the invariant distribution using DGA with memory.
@@ -70,6 +82,20 @@ def reweight(
         If True, return the projection coefficients.
     return_mem_coef : bool, optional
         If True, return the memory-correction coefficients.
+    matrices : tuple of ndarray, optional
+        DGA matrices ``(a, b, c0)``, as returned by :func:`reweight_matrices`
+        with the same arguments. If given, these are used instead of
+        computing them again from the trajectories.
+    n_jobs : int, optional
+        Number of memory terms to compute concurrently using threads
+        when computing the DGA matrices. If None or 1, compute them one
+        at a time.
+    compute_dtype : dtype, optional
+        Floating point type used to compute the DGA matrices. See
+        :func:`reweight_matrices`.
+    device : {"cpu", "cuda"}, optional
+        Device on which to compute the DGA matrices. See
+        :func:`reweight_matrices`.
 
     Returns
     -------
@@ -86,15 +112,36 @@ def reweight(
     assert (
         return_projection or return_solution or return_coef or return_mem_coef
     )
-    a, b, c0 = reweight_matrices(
-        basis, weights, lag, mem, test_basis=test_basis
-    )
+    if matrices is None:
+        matrices = reweight_matrices(
+            basis,
+            weights,
+            lag,
+            mem,
+            test_basis=test_basis,
+            n_jobs=n_jobs,
+            compute_dtype=compute_dtype,
+            device=device,
+        )
+    a, b, c0 = matrices
     coef, mem_coef = solve(a, b, c0)
+    if return_projection or return_solution:
+        projection = reweight_projection(basis, weights, coef)
     out = []
     if return_projection:
-        out.append(reweight_projection(basis, weights, coef))
+        out.append(projection)
     if return_solution:
-        out.append(reweight_solution(basis, weights, lag, mem, coef, mem_coef))
+        out.append(
+            reweight_solution(
+                basis,
+                weights,
+                lag,
+                mem,
+                coef,
+                mem_coef,
+                projection=projection,
+            )
+        )
     if return_coef:
         out.append(coef)
     if return_mem_coef:
@@ -104,7 +151,16 @@ def reweight(
     return out
 
 
-def reweight_matrices(basis, weights, lag, mem, test_basis=None):
+def reweight_matrices(
+    basis,
+    weights,
+    lag,
+    mem,
+    test_basis=None,
+    n_jobs=None,
+    compute_dtype=None,
+    device="cpu",
+):
     """
     Compute DGA matrices for estimating the invariant distribution.
 
@@ -127,6 +183,22 @@ def reweight_matrices(basis, weights, lag, mem, test_basis=None):
     test_basis : sequence of (n_frames[i], n_basis) {ndarray, sparse matrix} of float, optional
         Test basis against which to minimize the error. Must have the
         same dimension as `basis`. If `None`, use `basis`.
+    n_jobs : int, optional
+        Number of memory terms to compute concurrently using threads.
+        If None or 1, compute them one at a time.
+    compute_dtype : dtype, optional
+        Floating point type used to compute the contribution of each
+        trajectory to the DGA matrices. Using float32 roughly halves the
+        memory traffic and cost of this step, at the price of rounding
+        errors in the DGA matrices, which can matter if they are poorly
+        conditioned. The contributions are summed in float64. If None,
+        use the precision of the inputs.
+    device : {"cpu", "cuda"}, optional
+        Device on which to compute the DGA matrices. If "cuda", each
+        trajectory is copied to the GPU using CuPy, which must be
+        installed, and the DGA matrices are accumulated there and copied
+        back. Only dense bases are supported on the GPU. This pays off
+        for large dense bases, where the matrix products dominate.
 
     Returns
     -------
@@ -141,34 +213,39 @@ def reweight_matrices(basis, weights, lag, mem, test_basis=None):
     if test_basis is None:
         test_basis = basis
 
-    assert lag % (mem + 1) == 0
-    dlag = lag // (mem + 1)
+    lags = _memlags(lag, mem)
     n_basis = basis[0].shape[1]
 
     a = np.zeros((mem + 1, n_basis, n_basis))
     b = np.zeros((mem + 1, n_basis))
     c0 = np.zeros((n_basis, n_basis))
+    a, b, c0 = _to_device(device, a, b, c0)
 
-    for x, y, w in zip_equal(test_basis, basis, weights):
-        n_frames = len(w)
-        assert x.shape == (n_frames, n_basis)
-        assert y.shape == (n_frames, n_basis)
-        assert w.shape == (n_frames,)
+    with _lag_executor(n_jobs, len(lags)) as executor:
+        for x, y, w in zip_equal(test_basis, basis, weights):
+            n_frames = len(w)
+            assert x.shape == (n_frames, n_basis)
+            assert y.shape == (n_frames, n_basis)
+            assert w.shape == (n_frames,)
 
-        if n_frames <= lag:
-            assert np.all(w == 0.0)
-            continue
-        end = n_frames - lag
-        assert np.all(w[end:] == 0.0)
+            if n_frames <= lag:
+                assert np.all(w == 0.0)
+                continue
+            end = n_frames - lag
+            assert np.all(w[end:] == 0.0)
+
+            if compute_dtype is not None:
+                x = x.astype(compute_dtype, copy=False)
+                y = y.astype(compute_dtype, copy=False)
+                w = w.astype(compute_dtype, copy=False)
+            x, y, w = _to_device(device, x, y, w)
 
-        wy = linalg.scale_rows(w[:end], y[:end])
-        for n in range(mem + 1):
-            dx = (x[(n + 1) * dlag : end + (n + 1) * dlag] - x[:end]).T
-            a[n] += dx @ wy
-            b[n] += dx @ w[:end]
-        c0[:] += x[:end].T @ wy
+            wy = linalg.scale_rows(w[:end], y[:end])
+            terms = functools.partial(_reweight_terms, x, w[:end], wy)
+            _add_lag_terms(a, b, terms, lags, executor)
+            c0[:] += x[:end].T @ wy
 
-    return a, b, c0
+    return _from_device(device, a, b, c0)
 
 
 def reweight_projection(basis, weights, coef):
@@ -194,7 +271,9 @@ def reweight_projection(basis, weights, coef):
     return [w * (y @ coef + 1.0) for y, w in zip_equal(basis, weights)]
 
 
-def reweight_solution(basis, weights, lag, mem, coef, mem_coef):
+def reweight_solution(
+    basis, weights, lag, mem, coef, mem_coef, projection=None
+):
     """
     Returns a stochastic approximation of the invariant distribution.
 
@@ -218,6 +297,10 @@ def reweight_solution(basis, weights, lag, mem, coef, mem_coef):
         Projection coefficients.
     mem_coef : (mem, n_basis) ndarray of float
         Memory-correction coefficients.
+    projection : list of (n_frames[i],) ndarray of float, optional
+        Projected invariant distribution, as returned by
+        :func:`reweight_projection` with the same `coef`. If given, it is
+        used instead of computing it again.
 
     Returns
     -------
@@ -225,12 +308,17 @@ def reweight_solution(basis, weights, lag, mem, coef, mem_coef):
         Estimate of the invariant distribution.
 
     """
-    assert lag % (mem + 1) == 0
-    dlag = lag // (mem + 1)
+    dlag = _memlags(lag, mem)[0]
     n_basis = basis[0].shape[1]
+    # transpose once up front, into the contiguous layout that sparse
+    # bases would otherwise copy it to for every trajectory
+    mem_coef_t = np.ascontiguousarray(mem_coef.T)
+
+    if projection is None:
+        projection = [None] * len(basis)
 
     out = []
-    for y, w in zip_equal(basis, weights):
+    for y, w, p in zip_equal(basis, weights, projection):
         n_frames = y.shape[0]
         assert y.shape == (n_frames, n_basis)
         assert w.shape == (n_frames,)
@@ -241,12 +329,11 @@ def reweight_solution(basis, weights, lag, mem, coef, mem_coef):
             continue
         assert np.all(w[-lag:] == 0.0)
 
-        pad = np.zeros(dlag)
-        u = w * (y @ coef + 1.0)
-        for v in mem_coef:
-            u = np.concatenate([pad, u[:-dlag]])
-            u -= w * (y @ v)
-        u = np.concatenate([pad, u[:-dlag]])
+        u = w * (y @ coef + 1.0) if p is None else p.copy()
+        # a single matrix product with all the memory-correction
+        # coefficients is faster than one matrix-vector product per
+        # memory term, especially for sparse bases
+        _reweight_solution_helper(u, w, y @ mem_coef_t, dlag)
         out.append(u)
     return out
 
@@ -263,6 +350,10 @@ def forward_committor(
     return_solution=True,
     return_coef=False,
     return_mem_coef=False,
+    matrices=None,
+    n_jobs=None,
+    compute_dtype=None,
+    device="cpu",
 ):
     """
     Estimate the forward committor using DGA with memory.
@@ -298,6 +389,21 @@ def forward_committor(
         If True, return the projection coefficients.
     return_mem_coef : bool, optional
         If True, return the memory-correction coefficients.
+    matrices : tuple of ndarray, optional
+        DGA matrices ``(a, b, c0)``, as returned by
+        :func:`forward_feynman_kac_matrices` with a `function` of 0 and
+        otherwise the same arguments. If given, these are used instead
+        of computing them again from the trajectories.
+    n_jobs : int, optional
+        Number of memory terms to compute concurrently using threads
+        when computing the DGA matrices. If None or 1, compute them one
+        at a time.
+    compute_dtype : dtype, optional
+        Floating point type used to compute the DGA matrices. See
+        :func:`forward_feynman_kac_matrices`.
+    device : {"cpu", "cuda"}, optional
+        Device on which to compute the DGA matrices. See
+        :func:`forward_feynman_kac_matrices`.
 
     Returns
     -------
@@ -324,6 +430,10 @@ def forward_committor(
         return_solution,
         return_coef,
         return_mem_coef,
+        matrices=matrices,
+        n_jobs=n_jobs,
+        compute_dtype=compute_dtype,
+        device=device,
     )
 
 
@@ -339,6 +449,10 @@ def forward_mfpt(
     return_solution=True,
     return_coef=False,
     return_mem_coef=False,
+    matrices=None,
+    n_jobs=None,
+    compute_dtype=None,
+    device="cpu",
 ):
     """
     Estimate the forward mean first passage time (MFPT) using DGA
@@ -375,6 +489,21 @@ def forward_mfpt(
         If True, return the projection coefficients.
     return_mem_coef : bool, optional
         If True, return the memory-correction coefficients.
+    matrices : tuple of ndarray, optional
+        DGA matrices ``(a, b, c0)``, as returned by
+        :func:`forward_feynman_kac_matrices` with a `function` of 1 and
+        otherwise the same arguments. If given, these are used instead
+        of computing them again from the trajectories.
+    n_jobs : int, optional
+        Number of memory terms to compute concurrently using threads
+        when computing the DGA matrices. If None or 1, compute them one
+        at a time.
+    compute_dtype : dtype, optional
+        Floating point type used to compute the DGA matrices. See
+        :func:`forward_feynman_kac_matrices`.
+    device : {"cpu", "cuda"}, optional
+        Device on which to compute the DGA matrices. See
+        :func:`forward_feynman_kac_matrices`.
 
     Returns
     -------
@@ -401,6 +530,10 @@ def forward_mfpt(
         return_solution,
         return_coef,
         return_mem_coef,
+        matrices=matrices,
+        n_jobs=n_jobs,
+        compute_dtype=compute_dtype,
+        device=device,
     )
 
 
@@ -417,6 +550,10 @@ def forward_feynman_kac(
     return_solution=True,
     return_coef=False,
     return_mem_coef=False,
+    matrices=None,
+    n_jobs=None,
+    compute_dtype=None,
+    device="cpu",
 ):
     """
     Solve a forward Feynman-Kac problem using DGA with memory.
@@ -454,6 +591,21 @@ def forward_feynman_kac(
         If True, return the projection coefficients.
     return_mem_coef : bool, optional
         If True, return the memory-correction coefficients.
+    matrices : tuple of ndarray, optional
+        DGA matrices ``(a, b, c0)``, as returned by
+        :func:`forward_feynman_kac_matrices` with the same arguments. If
+        given, these are used instead of computing them again from the
+        trajectories.
+    n_jobs : int, optional
+        Number of memory terms to compute concurrently using threads
+        when computing the DGA matrices. If None or 1, compute them one
+        at a time.
+    compute_dtype : dtype, optional
+        Floating point type used to compute the DGA matrices. See
+        :func:`forward_feynman_kac_matrices`.
+    device : {"cpu", "cuda"}, optional
+        Device on which to compute the DGA matrices. See
+        :func:`forward_feynman_kac_matrices`.
 
     Returns
     -------
@@ -470,24 +622,39 @@ def forward_feynman_kac(
     assert (
         return_projection or return_solution or return_coef or return_mem_coef
     )
-    a, b, c0 = forward_feynman_kac_matrices(
-        basis,
-        weights,
-        in_domain,
-        function,
-        guess,
-        lag,
-        mem,
-        test_basis=test_basis,
-    )
+    if matrices is None:
+        matrices = forward_feynman_kac_matrices(
+            basis,
+            weights,
+            in_domain,
+            function,
+            guess,
+            lag,
+            mem,
+            test_basis=test_basis,
+            n_jobs=n_jobs,
+            compute_dtype=compute_dtype,
+            device=device,
+        )
+    a, b, c0 = matrices
     coef, mem_coef = solve(a, b, c0)
+    if return_projection or return_solution:
+        projection = forward_feynman_kac_projection(basis, guess, coef)
     out = []
     if return_projection:
-        out.append(forward_feynman_kac_projection(basis, guess, coef))
+        out.append(projection)
     if return_solution:
         out.append(
             forward_feynman_kac_solution(
-                basis, in_domain, function, guess, lag, mem, coef, mem_coef
+                basis,
+                in_domain,
+                function,
+                guess,
+                lag,
+                mem,
+                coef,
+                mem_coef,
+                projection=projection,
             )
         )
     if return_coef:
@@ -500,7 +667,17 @@ def forward_feynman_kac(
 
 
 def forward_feynman_kac_matrices(
-    basis, weights, in_domain, function, guess, lag, mem, test_basis=None
+    basis,
+    weights,
+    in_domain,
+    function,
+    guess,
+    lag,
+    mem,
+    test_basis=None,
+    n_jobs=None,
+    compute_dtype=None,
+    device="cpu",
 ):
     """
     Solve a forward Feynman-Kac problem using DGA with memory.
@@ -530,6 +707,22 @@ def forward_feynman_kac_matrices(
     test_basis : sequence of (n_frames[i], n_basis) {ndarray, sparse matrix} of float, optional
         Test basis against which to minimize the error. Must have the
         same dimension as `basis`. If `None`, use `basis`.
+    n_jobs : int, optional
+        Number of memory terms to compute concurrently using threads.
+        If None or 1, compute them one at a time.
+    compute_dtype : dtype, optional
+        Floating point type used to compute the contribution of each
+        trajectory to the DGA matrices. Using float32 roughly halves the
+        memory traffic and cost of this step, at the price of rounding
+        errors in the DGA matrices, which can matter if they are poorly
+        conditioned. The contributions are summed in float64. If None,
+        use the precision of the inputs.
+    device : {"cpu", "cuda"}, optional
+        Device on which to compute the DGA matrices. If "cuda", each
+        trajectory is copied to the GPU using CuPy, which must be
+        installed, and the DGA matrices are accumulated there and copied
+        back. Only dense bases are supported on the GPU. This pays off
+        for large dense bases, where the matrix products dominate.
 
     Returns
     -------
@@ -545,42 +738,63 @@ def forward_feynman_kac_matrices(
         test_basis = basis
     function = _broadcast_integrand(function, guess)
 
-    assert lag % (mem + 1) == 0
-    dlag = lag // (mem + 1)
+    lags = _memlags(lag, mem)
     n_basis = basis[0].shape[1]
 
     a = np.zeros((mem + 1, n_basis, n_basis))
     b = np.zeros((mem + 1, n_basis))
     c0 = np.zeros((n_basis, n_basis))
+    a, b, c0 = _to_device(device, a, b, c0)
+
+    with _lag_executor(n_jobs, len(lags)) as executor:
+        for x, y, w, d, f, g in zip_equal(
+            test_basis, basis, weights, in_domain, function, guess
+        ):
+            n_frames = len(w)
+            assert x.shape == (n_frames, n_basis)
+            assert y.shape == (n_frames, n_basis)
+            assert w.shape == (n_frames,)
+            assert d.shape == (n_frames,)
+            assert f.shape == (n_frames - 1,)
+            assert g.shape == (n_frames,)
+
+            if n_frames <= lag:
+                assert np.all(w == 0.0)
+                continue
+            end = n_frames - lag
+            assert np.all(w[end:] == 0.0)
+
+            if compute_dtype is not None:
+                x = x.astype(compute_dtype, copy=False)
+                y = y.astype(compute_dtype, copy=False)
+                w = w.astype(compute_dtype, copy=False)
+
+            stop = forward_stop(d)
+            h = _running_integral(f)
+            h += g
+
+            # frames outside of the domain have already stopped, so they
+            # don't contribute to the memory terms and can be skipped when
+            # there are enough of them to be worth gathering the rest
+            ix = np.flatnonzero(d[:end])
+            gather = len(ix) < _GATHER_FRACTION * end
+            if not gather:
+                ix = np.arange(end)
+
+            x, y, w, h, ix, stop = _to_device(device, x, y, w, h, ix, stop[ix])
+            xw = linalg.scale_rows(w[:end], x[:end]).T
+            c0[:] += xw @ y[:end]
+            if gather:
+                xw = linalg.scale_rows(w[ix], x[ix]).T
+                y0 = y[ix]
+            else:
+                y0 = y[:end]
+            terms = functools.partial(
+                _forward_feynman_kac_terms, xw, y, y0, h, ix, stop
+            )
+            _add_lag_terms(a, b, terms, lags, executor)
 
-    for x, y, w, d, f, g in zip_equal(
-        test_basis, basis, weights, in_domain, function, guess
-    ):
-        n_frames = len(w)
-        assert x.shape == (n_frames, n_basis)
-        assert y.shape == (n_frames, n_basis)
-        assert w.shape == (n_frames,)
-        assert d.shape == (n_frames,)
-        assert f.shape == (n_frames - 1,)
-        assert g.shape == (n_frames,)
-
-        if n_frames <= lag:
-            assert np.all(w == 0.0)
-            continue
-        end = n_frames - lag
-        assert np.all(w[end:] == 0.0)
-
-        ix = np.arange(end)
-        stop = forward_stop(d)[:end]
-        intf = np.insert(np.cumsum(f), 0, 0.0)
-        xw = linalg.scale_rows(w[:end], x[:end]).T
-        for n in range(mem + 1):
-            iy = np.minimum(ix + (n + 1) * dlag, stop)
-            a[n] += xw @ (y[iy] - y[:end])
-            b[n] += xw @ ((g[iy] - g[:end]) + (intf[iy] - intf[:end]))
-        c0[:] += xw @ y[:end]
-
-    return a, b, c0
+    return _from_device(device, a, b, c0)
 
 
 def forward_feynman_kac_projection(basis, guess, coef):
@@ -607,7 +821,15 @@ def forward_feynman_kac_projection(basis, guess, coef):
 
 
 def forward_feynman_kac_solution(
-    basis, in_domain, function, guess, lag, mem, coef, mem_coef
+    basis,
+    in_domain,
+    function,
+    guess,
+    lag,
+    mem,
+    coef,
+    mem_coef,
+    projection=None,
 ):
     """
     Returns a stochastic approximation of the solution of a forward
@@ -636,6 +858,10 @@ def forward_feynman_kac_solution(
         Projection coefficients.
     mem_coef : (mem, n_basis) ndarray of float
         Memory-correction coefficients.
+    projection : list of (n_frames[i],) ndarray of float, optional
+        Projected solution, as returned by
+        :func:`forward_feynman_kac_projection` with the same `coef`. If
+        given, it is used instead of computing it again.
 
     Returns
     -------
@@ -645,12 +871,17 @@ def forward_feynman_kac_solution(
     """
     function = _broadcast_integrand(function, guess)
 
-    assert lag % (mem + 1) == 0
-    dlag = lag // (mem + 1)
+    dlag = _memlags(lag, mem)[0]
     n_basis = basis[0].shape[1]
+    mem_coef_t = np.ascontiguousarray(mem_coef.T)
+
+    if projection is None:
+        projection = [None] * len(basis)
 
     out = []
-    for y, d, f, g in zip_equal(basis, in_domain, function, guess):
+    for y, d, f, g, p in zip_equal(
+        basis, in_domain, function, guess, projection
+    ):
         n_frames = y.shape[0]
         assert y.shape == (n_frames, n_basis)
         assert d.shape == (n_frames,)
@@ -662,14 +893,10 @@ def forward_feynman_kac_solution(
             continue
 
         stop = np.minimum(np.arange(dlag, len(d)), forward_stop(d)[:-dlag])
-        intf = np.insert(np.cumsum(f), 0, 0.0)
+        intf = _running_integral(f)
         r = intf[stop] - intf[:-dlag]
-        pad = np.full(dlag, np.nan)
-        u = y @ coef + g
-        for v in mem_coef:
-            u = np.concatenate([u[stop] + r, pad])
-            u -= y @ v
-        u = np.concatenate([u[stop] + r, pad])
+        u = y @ coef + g if p is None else p.copy()
+        _forward_solution_helper(u, y @ mem_coef_t, stop, r)
         out.append(u)
     return out
 
@@ -686,6 +913,10 @@ def backward_committor(
     return_solution=True,
     return_coef=False,
     return_mem_coef=False,
+    matrices=None,
+    n_jobs=None,
+    compute_dtype=None,
+    device="cpu",
 ):
     """
     Estimate the backward committor using DGA with memory.
@@ -721,6 +952,21 @@ def backward_committor(
         If True, return the projection coefficients.
     return_mem_coef : bool, optional
         If True, return the memory-correction coefficients.
+    matrices : tuple of ndarray, optional
+        DGA matrices ``(a, b, c0)``, as returned by
+        :func:`backward_feynman_kac_matrices` with a `function` of 0 and
+        otherwise the same arguments. If given, these are used instead
+        of computing them again from the trajectories.
+    n_jobs : int, optional
+        Number of memory terms to compute concurrently using threads
+        when computing the DGA matrices. If None or 1, compute them one
+        at a time.
+    compute_dtype : dtype, optional
+        Floating point type used to compute the DGA matrices. See
+        :func:`backward_feynman_kac_matrices`.
+    device : {"cpu", "cuda"}, optional
+        Device on which to compute the DGA matrices. See
+        :func:`backward_feynman_kac_matrices`.
 
     Returns
     -------
@@ -747,6 +993,10 @@ def backward_committor(
         return_solution,
         return_coef,
         return_mem_coef,
+        matrices=matrices,
+        n_jobs=n_jobs,
+        compute_dtype=compute_dtype,
+        device=device,
     )
 
 
@@ -762,6 +1012,10 @@ def backward_mfpt(
     return_solution=True,
     return_coef=False,
     return_mem_coef=False,
+    matrices=None,
+    n_jobs=None,
+    compute_dtype=None,
+    device="cpu",
 ):
     """
     Estimate the backward mean first passage time (MFPT) using DGA
@@ -798,6 +1052,21 @@ def backward_mfpt(
         If True, return the projection coefficients.
     return_mem_coef : bool, optional
         If True, return the memory-correction coefficients.
+    matrices : tuple of ndarray, optional
+        DGA matrices ``(a, b, c0)``, as returned by
+        :func:`backward_feynman_kac_matrices` with a `function` of 1 and
+        otherwise the same arguments. If given, these are used instead
+        of computing them again from the trajectories.
+    n_jobs : int, optional
+        Number of memory terms to compute concurrently using threads
+        when computing the DGA matrices. If None or 1, compute them one
+        at a time.
+    compute_dtype : dtype, optional
+        Floating point type used to compute the DGA matrices. See
+        :func:`backward_feynman_kac_matrices`.
+    device : {"cpu", "cuda"}, optional
+        Device on which to compute the DGA matrices. See
+        :func:`backward_feynman_kac_matrices`.
 
     Returns
     -------
@@ -824,6 +1093,10 @@ def backward_mfpt(
         return_solution,
         return_coef,
         return_mem_coef,
+        matrices=matrices,
+        n_jobs=n_jobs,
+        compute_dtype=compute_dtype,
+        device=device,
     )
 
 
@@ -840,6 +1113,10 @@ def backward_feynman_kac(
     return_solution=True,
     return_coef=False,
     return_mem_coef=False,
+    matrices=None,
+    n_jobs=None,
+    compute_dtype=None,
+    device="cpu",
 ):
     """
     Solve a backward Feynman-Kac problem using DGA with memory.
@@ -877,6 +1154,21 @@ def backward_feynman_kac(
         If True, return the projection coefficients.
     return_mem_coef : bool, optional
         If True, return the memory-correction coefficients.
+    matrices : tuple of ndarray, optional
+        DGA matrices ``(a, b, c0)``, as returned by
+        :func:`backward_feynman_kac_matrices` with the same arguments. If
+        given, these are used instead of computing them again from the
+        trajectories.
+    n_jobs : int, optional
+        Number of memory terms to compute concurrently using threads
+        when computing the DGA matrices. If None or 1, compute them one
+        at a time.
+    compute_dtype : dtype, optional
+        Floating point type used to compute the DGA matrices. See
+        :func:`backward_feynman_kac_matrices`.
+    device : {"cpu", "cuda"}, optional
+        Device on which to compute the DGA matrices. See
+        :func:`backward_feynman_kac_matrices`.
 
     Returns
     -------
@@ -893,24 +1185,39 @@ def backward_feynman_kac(
     assert (
         return_projection or return_solution or return_coef or return_mem_coef
     )
-    a, b, c0 = backward_feynman_kac_matrices(
-        basis,
-        weights,
-        in_domain,
-        function,
-        guess,
-        lag,
-        mem,
-        test_basis=test_basis,
-    )
+    if matrices is None:
+        matrices = backward_feynman_kac_matrices(
+            basis,
+            weights,
+            in_domain,
+            function,
+            guess,
+            lag,
+            mem,
+            test_basis=test_basis,
+            n_jobs=n_jobs,
+            compute_dtype=compute_dtype,
+            device=device,
+        )
+    a, b, c0 = matrices
     coef, mem_coef = solve(a, b, c0)
+    if return_projection or return_solution:
+        projection = backward_feynman_kac_projection(basis, guess, coef)
     out = []
     if return_projection:
-        out.append(backward_feynman_kac_projection(basis, guess, coef))
+        out.append(projection)
     if return_solution:
         out.append(
             backward_feynman_kac_solution(
-                basis, in_domain, function, guess, lag, mem, coef, mem_coef
+                basis,
+                in_domain,
+                function,
+                guess,
+                lag,
+                mem,
+                coef,
+                mem_coef,
+                projection=projection,
             )
         )
     if return_coef:
@@ -931,6 +1238,9 @@ def backward_feynman_kac_matrices(
     lag,
     mem,
     test_basis=None,
+    n_jobs=None,
+    compute_dtype=None,
+    device="cpu",
 ):
     """
     Solve a backward Feynman-Kac problem using DGA with memory.
@@ -960,6 +1270,22 @@ def backward_feynman_kac_matrices(
     test_basis : sequence of (n_frames[i], n_basis) {ndarray, sparse matrix} of float, optional
         Test basis against which to minimize the error. Must have the
         same dimension as `basis`. If `None`, use `basis`.
+    n_jobs : int, optional
+        Number of memory terms to compute concurrently using threads.
+        If None or 1, compute them one at a time.
+    compute_dtype : dtype, optional
+        Floating point type used to compute the contribution of each
+        trajectory to the DGA matrices. Using float32 roughly halves the
+        memory traffic and cost of this step, at the price of rounding
+        errors in the DGA matrices, which can matter if they are poorly
+        conditioned. The contributions are summed in float64. If None,
+        use the precision of the inputs.
+    device : {"cpu", "cuda"}, optional
+        Device on which to compute the DGA matrices. If "cuda", each
+        trajectory is copied to the GPU using CuPy, which must be
+        installed, and the DGA matrices are accumulated there and copied
+        back. Only dense bases are supported on the GPU. This pays off
+        for large dense bases, where the matrix products dominate.
 
     Returns
     -------
@@ -975,42 +1301,64 @@ def backward_feynman_kac_matrices(
         test_basis = basis
     function = _broadcast_integrand(function, guess)
 
-    assert lag % (mem + 1) == 0
-    dlag = lag // (mem + 1)
+    lags = _memlags(lag, mem)
     n_basis = basis[0].shape[1]
 
     a = np.zeros((mem + 1, n_basis, n_basis))
     b = np.zeros((mem + 1, n_basis))
     c0 = np.zeros((n_basis, n_basis))
+    a, b, c0 = _to_device(device, a, b, c0)
+
+    with _lag_executor(n_jobs, len(lags)) as executor:
+        for x, y, w, d, f, g in zip_equal(
+            test_basis, basis, weights, in_domain, function, guess
+        ):
+            n_frames = len(w)
+            assert x.shape == (n_frames, n_basis)
+            assert y.shape == (n_frames, n_basis)
+            assert w.shape == (n_frames,)
+            assert d.shape == (n_frames,)
+            assert f.shape == (n_frames - 1,)
+            assert g.shape == (n_frames,)
+
+            if n_frames <= lag:
+                assert np.all(w == 0.0)
+                continue
+            end = n_frames - lag
+            assert np.all(w[end:] == 0.0)
+
+            if compute_dtype is not None:
+                x = x.astype(compute_dtype, copy=False)
+                y = y.astype(compute_dtype, copy=False)
+                w = w.astype(compute_dtype, copy=False)
+
+            stop = backward_stop(d)
+            h = _running_integral(f)
+            np.subtract(g, h, out=h)
+
+            # frames outside of the domain have already stopped, so they
+            # don't contribute to the memory terms and can be skipped when
+            # there are enough of them to be worth gathering the rest
+            ix = np.flatnonzero(d[lag:])
+            gather = len(ix) < _GATHER_FRACTION * end
+            if not gather:
+                ix = np.arange(end)
+            ix += lag
+
+            x, y, w, h, ix, stop = _to_device(device, x, y, w, h, ix, stop[ix])
+            xw = linalg.scale_rows(w[:end], x[lag:]).T
+            c0[:] += xw @ y[lag:]
+            if gather:
+                xw = linalg.scale_rows(w[ix - lag], x[ix]).T
+                y0 = y[ix]
+            else:
+                y0 = y[lag:]
+            terms = functools.partial(
+                _backward_feynman_kac_terms, xw, y, y0, h, ix, stop
+            )
+            _add_lag_terms(a, b, terms, lags, executor)
 
-    for x, y, w, d, f, g in zip_equal(
-        test_basis, basis, weights, in_domain, function, guess
-    ):
-        n_frames = len(w)
-        assert x.shape == (n_frames, n_basis)
-        assert y.shape == (n_frames, n_basis)
-        assert w.shape == (n_frames,)
-        assert d.shape == (n_frames,)
-        assert f.shape == (n_frames - 1,)
-        assert g.shape == (n_frames,)
-
-        if n_frames <= lag:
-            assert np.all(w == 0.0)
-            continue
-        end = n_frames - lag
-        assert np.all(w[end:] == 0.0)
-
-        ix = np.arange(lag, n_frames)
-        stop = backward_stop(d)[lag:]
-        intf = np.insert(np.cumsum(f), 0, 0.0)
-        xw = linalg.scale_rows(w[:end], x[lag:]).T
-        for n in range(mem + 1):
-            iy = np.maximum(ix - (n + 1) * dlag, stop)
-            a[n] += xw @ (y[iy] - y[lag:])
-            b[n] += xw @ ((g[iy] - g[lag:]) + (intf[lag:] - intf[iy]))
-        c0[:] += xw @ y[lag:]
-
-    return a, b, c0
+    return _from_device(device, a, b, c0)
 
 
 def backward_feynman_kac_projection(basis, guess, coef):
@@ -1037,7 +1385,15 @@ def backward_feynman_kac_projection(basis, guess, coef):
 
 
 def backward_feynman_kac_solution(
-    basis, in_domain, function, guess, lag, mem, coef, mem_coef
+    basis,
+    in_domain,
+    function,
+    guess,
+    lag,
+    mem,
+    coef,
+    mem_coef,
+    projection=None,
 ):
     """
     Returns a stochastic approximation of the solution of a backward
@@ -1066,6 +1422,10 @@ def backward_feynman_kac_solution(
         Projection coefficients.
     mem_coef : (mem, n_basis) ndarray of float
         Memory-correction coefficients.
+    projection : list of (n_frames[i],) ndarray of float, optional
+        Projected solution, as returned by
+        :func:`backward_feynman_kac_projection` with the same `coef`. If
+        given, it is used instead of computing it again.
 
     Returns
     -------
@@ -1075,12 +1435,17 @@ def backward_feynman_kac_solution(
     """
     function = _broadcast_integrand(function, guess)
 
-    assert lag % (mem + 1) == 0
-    dlag = lag // (mem + 1)
+    dlag = _memlags(lag, mem)[0]
     n_basis = basis[0].shape[1]
+    mem_coef_t = np.ascontiguousarray(mem_coef.T)
+
+    if projection is None:
+        projection = [None] * len(basis)
 
     out = []
-    for y, d, f, g in zip_equal(basis, in_domain, function, guess):
+    for y, d, f, g, p in zip_equal(
+        basis, in_domain, function, guess, projection
+    ):
         n_frames = y.shape[0]
         assert y.shape == (n_frames, n_basis)
         assert d.shape == (n_frames,)
@@ -1092,14 +1457,10 @@ def backward_feynman_kac_solution(
             continue
 
         stop = np.maximum(np.arange(len(d) - dlag), backward_stop(d)[dlag:])
-        intf = np.insert(np.cumsum(f), 0, 0.0)
+        intf = _running_integral(f)
         r = intf[dlag:] - intf[stop]
-        pad = np.full(dlag, np.nan)
-        u = y @ coef + g
-        for v in mem_coef:
-            u = np.concatenate([pad, u[stop] + r])
-            u -= y @ v
-        u = np.concatenate([pad, u[stop] + r])
+        u = y @ coef + g if p is None else p.copy()
+        _backward_solution_helper(u, y @ mem_coef_t, stop, r)
         out.append(u)
     return out
 
@@ -1131,15 +1492,25 @@ def solve(a, b, c0):
     assert a.shape == (mem + 1, n_basis, n_basis)
     assert b.shape == (mem + 1, n_basis)
 
-    b = b[..., None]
-
-    inv = linalg.inv(c0)
-    a = inv @ a
-    b = inv @ b
+    if mem == 0:
+        # without memory, c0 cancels out of the solution
+        coef = linalg.solve(a[0], -b[0])
+        return coef, np.empty((0, n_basis))
+
+    # factor c0 once and solve against every memory term at the same
+    # time, rather than forming its inverse
+    solve_c0 = linalg.factorized(c0)
+    a = solve_c0(np.concatenate(a, axis=1))
+    a = a.reshape(n_basis, mem + 1, n_basis).swapaxes(0, 1)
+    b = solve_c0(b.T).T[..., None]
     c = a[::-1] + np.identity(n_basis)
+    # subtract the products one at a time, rather than stacking up to
+    # mem of them in a temporary array
+    tmp = np.empty((n_basis, n_basis))
     for n in range(1, mem + 1):
-        a[n] -= np.sum(c[-n:] @ a[:n], axis=0)
-        b[n] -= np.sum(c[-n:] @ b[:n], axis=0)
+        for k in range(n):
+            a[n] -= np.matmul(c[k - n], a[k], out=tmp)
+            b[n] -= c[k - n] @ b[k]
 
     b = b.reshape(b.shape[:2])
 
@@ -1148,7 +1519,130 @@ def solve(a, b, c0):
     return coef, mem_coef
 
 
+def _lag_executor(n_jobs, n_lags):
+    """Thread pool for computing memory terms, if requested."""
+    if n_jobs is None or n_jobs == 1 or n_lags == 1:
+        return contextlib.nullcontext()
+    return ThreadPoolExecutor(max_workers=n_jobs)
+
+
+def _add_lag_terms(a, b, func, lags, executor):
+    """Add the memory terms computed by `func` to `a` and `b`."""
+
+    def add(n):
+        an, bn = func(lags[n])
+        a[n] += an
+        b[n] += bn
+
+    if executor is None:
+        for n in range(len(lags)):
+            add(n)
+    else:
+        # each thread adds its own terms, so that at most one term per
+        # thread is held in memory at a time
+        for _ in executor.map(add, range(len(lags))):
+            pass
+
+
+def _to_device(device, *arrays):
+    """Copy arrays to `device`, if they aren't already there."""
+    if device == "cuda":
+        import cupy
+
+        return tuple(cupy.asarray(a) for a in arrays)
+    assert device == "cpu"
+    return arrays
+
+
+def _from_device(device, *arrays):
+    """Copy arrays from `device` back to the host."""
+    if device == "cuda":
+        import cupy
+
+        return tuple(cupy.asnumpy(a) for a in arrays)
+    assert device == "cpu"
+    return arrays
+
+
+def _reweight_terms(x, w, wy, t):
+    end = len(w)
+    dx = (x[t : end + t] - x[:end]).T
+    return dx @ wy, dx @ w
+
+
+def _forward_feynman_kac_terms(xw, y, y0, h, ix, stop, t):
+    iy = np.minimum(ix + t, stop)
+    # h grows along the trajectory, so only its increments are rounded to
+    # the precision of the basis
+    dh = (h[iy] - h[ix]).astype(xw.dtype, copy=False)
+    return xw @ (y[iy] - y0), xw @ dh
+
+
+def _backward_feynman_kac_terms(xw, y, y0, h, ix, stop, t):
+    iy = np.maximum(ix - t, stop)
+    dh = (h[iy] - h[ix]).astype(xw.dtype, copy=False)
+    return xw @ (y[iy] - y0), xw @ dh
+
+
+@nb.njit
+def _reweight_solution_helper(u, w, yv, dlag):
+    # apply the memory-correction recursion to u in place, which is safe
+    # since each frame only depends on earlier frames
+    n_frames, mem = yv.shape
+    for m in range(mem + 1):
+        for i in range(n_frames - 1, dlag - 1, -1):
+            u[i] = u[i - dlag]
+        u[:dlag] = 0.0
+        if m < mem:
+            for i in range(n_frames):
+                u[i] -= w[i] * yv[i, m]
+
+
+@nb.njit
+def _forward_solution_helper(u, yv, stop, r):
+    # apply the memory-correction recursion to u in place, which is safe
+    # since each frame only depends on itself and later frames
+    n_frames, mem = yv.shape
+    end = len(stop)
+    for m in range(mem + 1):
+        for i in range(end):
+            u[i] = u[stop[i]] + r[i]
+            if m < mem:
+                u[i] -= yv[i, m]
+        u[end:] = np.nan
+
+
+@nb.njit
+def _backward_solution_helper(u, yv, stop, r):
+    # apply the memory-correction recursion to u in place, which is safe
+    # since each frame only depends on itself and earlier frames
+    n_frames, mem = yv.shape
+    dlag = n_frames - len(stop)
+    for m in range(mem + 1):
+        for i in range(n_frames - 1, dlag - 1, -1):
+            u[i] = u[stop[i - dlag]] + r[i - dlag]
+            if m < mem:
+                u[i] -= yv[i, m]
+        u[:dlag] = np.nan
+
+
+@functools.lru_cache(maxsize=None)
+def _memlags(lag, mem):
+    """Lag times of the memory terms, which evenly divide `lag`."""
+    assert lag % (mem + 1) == 0
+    dlag = lag // (mem + 1)
+    return tuple(dlag * n for n in range(1, mem + 2))
+
+
 def _broadcast_integrand(f, trajs):
     if not np.iterable(f):
         f = [np.broadcast_to(f, traj.shape[0] - 1) for traj in trajs]
     return f
+
+
+def _running_integral(f):
+    """Integral of `f` from the first frame to each frame."""
+    out = np.empty(len(f) + 1)
+    out[0] = 0.0
+    np.cumsum(f, out=out[1:])
+    return out
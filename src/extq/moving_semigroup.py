@@ -2,11 +2,15 @@ import numba as nb
 import numpy as np
 
 
-@nb.njit
+@nb.njit(nogil=True)
 def moving_semigroup(a, k, f, *args):
     """
     Calculate a moving window of an associative binary operation.
 
+    Windows are evaluated in blocks of `k` + 1 output points using
+    forward and backward accumulations, so that each output point costs
+    fewer than three applications of the operation, regardless of `k`.
+
     Note that this function modifies the input array in-place.
 
     Parameters
@@ -67,7 +71,106 @@ def moving_semigroup(a, k, f, *args):
     return a[:out_len]
 
 
-def moving_matmul(a, k):
+@nb.njit(parallel=True, nogil=True)
+def moving_semigroup_parallel(a, k, f, *args):
+    """
+    Calculate a moving window of an associative binary operation in
+    parallel.
+
+    This is equivalent to :func:`moving_semigroup`, but the output is
+    split into segments which are evaluated in parallel. Note that this
+    function modifies the input array in-place.
+
+    Parameters
+    ----------
+    a : (m, ...) ndarray
+        Input time series. This must be at least 2D. This array is also
+        used for the output, and must be C-contiguous.
+    k : int
+        Size of the moving window.
+    f : callable
+        Associative binary operation taking two input arguments and
+        one output argument. This must be Numba-compiled.
+    *args
+        Additional arguments to `f`, if needed.
+
+    Returns
+    -------
+    (m - k + 1, ...) ndarray
+        Output time series. Each output point is the result of
+        `k` sequential input points reduced using the operation.
+
+    """
+    assert k >= 1
+    assert a.ndim >= 2  # indexing a 1D ndarray yields a scalar
+
+    if k == 1:
+        return a
+
+    out_len = a.shape[0] - k + 1
+    assert out_len >= 0
+
+    if out_len == 0:
+        return a[:0]
+
+    # segments consist of whole blocks of k + 1 output points, which are
+    # evaluated independently of each other
+    n_blocks = (out_len + k) // (k + 1)
+    n_segments = min(n_blocks, 4 * nb.get_num_threads())
+    bounds = np.empty(n_segments + 1, dtype=np.int64)
+    for s in range(n_segments + 1):
+        bounds[s] = min((s * n_blocks // n_segments) * (k + 1), out_len)
+
+    # each segment overwrites input points needed by the previous one,
+    # so save those points first
+    halo = np.empty((n_segments, k - 1) + a.shape[1:], dtype=a.dtype)
+    for s in range(n_segments):
+        for jj in range(min(k - 1, a.shape[0] - bounds[s + 1])):
+            halo[s, jj] = a[bounds[s + 1] + jj]
+
+    for s in nb.prange(n_segments):
+        start = bounds[s]
+        end = bounds[s + 1]
+
+        # temporary arrays
+        acc = np.empty((k,) + a.shape[1:], dtype=a.dtype)
+
+        for n in range(start, end):
+            j = n % (k + 1)
+
+            # backward and forward accumulations
+            if j == 0:
+                for jj in range(k - 1, -1, -1):
+                    if n + jj < end:
+                        x = a[n + jj]
+                    else:
+                        x = halo[s, n + jj - end]
+                    if jj == k - 1:
+                        acc[jj] = x
+                    else:
+                        f(x, acc[jj + 1], acc[jj], *args)
+            else:
+                if n + k - 1 < end:
+                    x = a[n + k - 1]
+                else:
+                    x = halo[s, n + k - 1 - end]
+                if j == 1:
+                    acc[j - 1] = x
+                else:
+                    f(acc[j - 2], x, acc[j - 1], *args)
+
+            # combine accumulations
+            if j == 0:
+                a[n] = acc[j]
+            elif j == k:
+                a[n] = acc[j - 1]
+            else:
+                f(acc[j], acc[j - 1], a[n], *args)
+
+    return a[:out_len]
+
+
+def moving_matmul(a, k, parallel=False, device="cpu"):
     """
     Calculate a moving matrix product.
 
@@ -80,6 +183,14 @@ def moving_matmul(a, k):
         for the output, and must be C-contiguous.
     k : int
         Size of the moving window.
+    parallel : bool, optional
+        If True, evaluate the output in parallel using Numba's
+        threading layer.
+    device : {"cpu", "cuda"}, optional
+        Device on which to evaluate the output. If "cuda", the input is
+        copied to the GPU, evaluated there, and copied back. The cost of
+        the transfers is only recovered for large inputs (on the order
+        of 100 MB).
 
     Returns
     -------
@@ -89,7 +200,39 @@ def moving_matmul(a, k):
 
     """
     assert a.ndim == 3 and a.shape[1] == a.shape[2]
-    return moving_semigroup(a, k, _choose_mm(a.shape[1]))
+    if device == "cuda":
+        return _moving_matmul_cuda(a, k)
+    assert device == "cpu"
+    if parallel:
+        return moving_semigroup_parallel(a, k, _choose_mm(a.shape[1]))
+    else:
+        return moving_semigroup(a, k, _choose_mm(a.shape[1]))
+
+
+def _moving_matmul_cuda(a, k, threads_per_block=128):
+    assert k >= 1
+    if k == 1:
+        return a
+    out_len = a.shape[0] - k + 1
+    assert out_len >= 0
+    if out_len == 0:
+        return a[:0]
+
+    # numba.cuda is slow to import, so only load it when it's used
+    from numba import cuda
+
+    from ._moving_semigroup_cuda import moving_matmul_kernel
+
+    # each thread evaluates one block of k + 1 output points, as in
+    # moving_semigroup, so the output can't alias the input
+    n_blocks = (out_len + k) // (k + 1)
+    d_a = cuda.to_device(a)
+    d_temp = cuda.device_array((n_blocks, k) + a.shape[1:], dtype=a.dtype)
+    d_out = cuda.device_array((out_len,) + a.shape[1:], dtype=a.dtype)
+    n_grid = (n_blocks + threads_per_block - 1) // threads_per_block
+    moving_matmul_kernel[n_grid, threads_per_block](d_a, k, d_temp, d_out)
+    d_out.copy_to_host(a[:out_len])
+    return a[:out_len]
 
 
 def _choose_mm(n):
@@ -106,18 +249,18 @@ def _choose_mm(n):
         return mm
 
 
-@nb.njit(fastmath=True)
+@nb.njit(nogil=True, fastmath=True)
 def mm(a, b, c):
     np.dot(a, b, c)
 
 
-@nb.njit(fastmath=True)
+@nb.njit(nogil=True, fastmath=True)
 def mm1(a, b, c):
     c_0_0 = a[0, 0] * b[0, 0]
     c[0, 0] = c_0_0
 
 
-@nb.njit(fastmath=True)
+@nb.njit(nogil=True, fastmath=True)
 def mm2(a, b, c):
     c_0_0 = a[0, 0] * b[0, 0] + a[0, 1] * b[1, 0]
     c_0_1 = a[0, 0] * b[0, 1] + a[0, 1] * b[1, 1]
@@ -129,7 +272,7 @@ def mm2(a, b, c):
     c[1, 1] = c_1_1
 
 
-@nb.njit(fastmath=True)
+@nb.njit(nogil=True, fastmath=True)
 def mm3(a, b, c):
     c_0_0 = a[0, 0] * b[0, 0] + a[0, 1] * b[1, 0] + a[0, 2] * b[2, 0]
     c_0_1 = a[0, 0] * b[0, 1] + a[0, 1] * b[1, 1] + a[0, 2] * b[2, 1]
@@ -151,7 +294,7 @@ def mm3(a, b, c):
     c[2, 2] = c_2_2
 
 
-@nb.njit(fastmath=True)
+@nb.njit(nogil=True, fastmath=True)
 def mm4(a, b, c):
     c_0_0 = (
         a[0, 0] * b[0, 0]
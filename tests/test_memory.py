@@ -0,0 +1,136 @@
+import numpy as np
+import pytest
+import scipy.sparse
+
+from extq.memory import (
+    backward_feynman_kac_projection,
+    backward_feynman_kac_solution,
+    forward_feynman_kac_projection,
+    forward_feynman_kac_solution,
+    reweight_projection,
+    reweight_solution,
+)
+from extq.stop import backward_stop, forward_stop
+
+
+def reweight_reference(basis, weights, lag, mem, coef, mem_coef):
+    dlag = lag // (mem + 1)
+    out = []
+    for y, w in zip(basis, weights):
+        if y.shape[0] <= lag:
+            out.append(np.zeros(y.shape[0]))
+            continue
+        pad = np.zeros(dlag)
+        u = w * (y @ coef + 1.0)
+        for v in mem_coef:
+            u = np.concatenate([pad, u[:-dlag]])
+            u -= w * (y @ v)
+        out.append(np.concatenate([pad, u[:-dlag]]))
+    return out
+
+
+def forward_reference(
+    basis, in_domain, function, guess, lag, mem, coef, mem_coef
+):
+    dlag = lag // (mem + 1)
+    out = []
+    for y, d, f, g in zip(basis, in_domain, function, guess):
+        if y.shape[0] <= lag:
+            out.append(np.full(y.shape[0], np.nan))
+            continue
+        stop = np.minimum(np.arange(dlag, len(d)), forward_stop(d)[:-dlag])
+        intf = np.insert(np.cumsum(f), 0, 0.0)
+        r = intf[stop] - intf[:-dlag]
+        pad = np.full(dlag, np.nan)
+        u = y @ coef + g
+        for v in mem_coef:
+            u = np.concatenate([u[stop] + r, pad])
+            u -= y @ v
+        out.append(np.concatenate([u[stop] + r, pad]))
+    return out
+
+
+def backward_reference(
+    basis, in_domain, function, guess, lag, mem, coef, mem_coef
+):
+    dlag = lag // (mem + 1)
+    out = []
+    for y, d, f, g in zip(basis, in_domain, function, guess):
+        if y.shape[0] <= lag:
+            out.append(np.full(y.shape[0], np.nan))
+            continue
+        stop = np.maximum(np.arange(len(d) - dlag), backward_stop(d)[dlag:])
+        intf = np.insert(np.cumsum(f), 0, 0.0)
+        r = intf[dlag:] - intf[stop]
+        pad = np.full(dlag, np.nan)
+        u = y @ coef + g
+        for v in mem_coef:
+            u = np.concatenate([pad, u[stop] + r])
+            u -= y @ v
+        out.append(np.concatenate([pad, u[stop] + r]))
+    return out
+
+
+def data(sparse, lag, seed):
+    rng = np.random.default_rng(seed)
+    n_basis = 4
+    basis, weights, in_domain, function, guess = [], [], [], [], []
+    # the last trajectory is no longer than the lag time
+    for n_frames in [300, 57, lag]:
+        d = rng.random(n_frames) < 0.8
+        y = rng.standard_normal((n_frames, n_basis)) * d[:, None]
+        basis.append(scipy.sparse.csr_matrix(y) if sparse else y)
+        w = rng.random(n_frames)
+        w[max(0, n_frames - lag) :] = 0.0
+        weights.append(w)
+        in_domain.append(d)
+        function.append(rng.random(n_frames - 1))
+        guess.append(rng.random(n_frames) * ~d)
+    return basis, weights, in_domain, function, guess
+
+
+def assert_same(actual, desired):
+    assert len(actual) == len(desired)
+    for a, b in zip(actual, desired):
+        np.testing.assert_allclose(a, b, rtol=1e-10, atol=1e-12)
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+@pytest.mark.parametrize("lag,mem", [(4, 1), (12, 3), (12, 5), (10, 9)])
+def test_solution(lag, mem, sparse):
+    basis, weights, in_domain, function, guess = data(sparse, lag, lag + mem)
+    rng = np.random.default_rng(mem)
+    coef = rng.standard_normal(4)
+    mem_coef = rng.standard_normal((mem, 4))
+
+    expected = reweight_reference(basis, weights, lag, mem, coef, mem_coef)
+    assert_same(
+        reweight_solution(basis, weights, lag, mem, coef, mem_coef), expected
+    )
+    projection = reweight_projection(basis, weights, coef)
+    assert_same(
+        reweight_solution(
+            basis, weights, lag, mem, coef, mem_coef, projection=projection
+        ),
+        expected,
+    )
+
+    for solution, project, reference in [
+        (
+            forward_feynman_kac_solution,
+            forward_feynman_kac_projection,
+            forward_reference,
+        ),
+        (
+            backward_feynman_kac_solution,
+            backward_feynman_kac_projection,
+            backward_reference,
+        ),
+    ]:
+        args = (basis, in_domain, function, guess, lag, mem, coef, mem_coef)
+        expected = reference(*args)
+        assert_same(solution(*args), expected)
+        assert_same(
+            solution(*args, projection=project(basis, guess, coef)),
+            expected,
+        )
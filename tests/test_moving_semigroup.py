@@ -0,0 +1,63 @@
+import functools
+import os
+import subprocess
+import sys
+import textwrap
+
+import numpy as np
+import pytest
+
+from extq.moving_semigroup import moving_matmul
+
+
+def naive_moving_matmul(a, k):
+    return np.array(
+        [functools.reduce(np.dot, a[t : t + k]) for t in range(len(a) - k + 1)]
+    )
+
+
+def lengths(k):
+    return sorted({k, k + 1, 2 * k + 2, 3 * k + 5, 100})
+
+
+@pytest.mark.parametrize("parallel", [False, True])
+@pytest.mark.parametrize("n", range(1, 8))
+@pytest.mark.parametrize("k", [1, 2, 3, 5, 8, 17])
+def test_moving_matmul(k, n, parallel):
+    rng = np.random.default_rng(k * 8 + n)
+    for m in lengths(k):
+        a = rng.uniform(0.0, 2.0 / n, size=(m, n, n))
+        expected = naive_moving_matmul(a, k)
+        out = moving_matmul(a.copy(), k, parallel=parallel)
+        assert out.shape == (m - k + 1, n, n)
+        np.testing.assert_allclose(out, expected, rtol=1e-10, atol=1e-12)
+
+
+@pytest.mark.parametrize("parallel", [False, True])
+def test_moving_matmul_empty(parallel):
+    a = np.ones((3, 2, 2))
+    assert moving_matmul(a, 4, parallel=parallel).shape == (0, 2, 2)
+
+
+def test_moving_matmul_cuda_simulator():
+    # the simulator has to be enabled before numba.cuda is imported, so
+    # run the comparison in a separate process
+    script = textwrap.dedent("""
+        import functools
+
+        import numpy as np
+
+        from extq.moving_semigroup import moving_matmul
+
+        rng = np.random.default_rng(0)
+        for n, k, m in [(1, 1, 4), (2, 3, 3), (3, 4, 23), (5, 5, 40)]:
+            a = rng.uniform(0.0, 2.0 / n, size=(m, n, n))
+            expected = [
+                functools.reduce(np.dot, a[t : t + k])
+                for t in range(m - k + 1)
+            ]
+            out = moving_matmul(a.copy(), k, device="cuda")
+            np.testing.assert_allclose(out, expected, rtol=1e-10)
+        """)
+    env = dict(os.environ, NUMBA_ENABLE_CUDASIM="1")
+    subprocess.run([sys.executable, "-c", script], env=env, check=True)
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from extq.dga._xdga import _backward_transitions, _forward_transitions
+from extq.moving_semigroup import moving_matmul
+
+
+def forward_reference(k, d, f, g, lag):
+    n_indices = k.shape[0]
+    m = np.zeros((n_indices + 1, n_indices + 1, k.shape[-1]))
+    m[:-1, :-1] = np.where(d[:, None, :-1], k, 0)
+    m[:-1, -1] = np.where(d[:, :-1], np.sum(k * f, axis=1), g[:, :-1])
+    m[-1, -1] = 1
+    return moving_product(m, lag)
+
+
+def backward_reference(k, d, f, g, lag):
+    n_indices = k.shape[0]
+    m = np.zeros((n_indices + 1, n_indices + 1, k.shape[-1]))
+    m[:-1, :-1] = np.where(d[None, :, 1:], k, 0)
+    m[-1, :-1] = np.where(d[:, 1:], np.sum(k * f, axis=0), g[:, 1:])
+    m[-1, -1] = 1
+    return moving_product(m, lag)
+
+
+def moving_product(m, lag):
+    m = np.ascontiguousarray(np.moveaxis(m, -1, 0))
+    return np.moveaxis(moving_matmul(m, lag), 0, -1)
+
+
+def transitions(n_indices, n_steps, seed):
+    rng = np.random.default_rng(seed)
+    k = rng.random((n_indices, n_indices, n_steps))
+    k /= np.sum(k, axis=1, keepdims=True)
+    d = rng.random((n_indices, n_steps + 1)) < 0.9
+    f = rng.random((n_indices, n_indices, n_steps))
+    g = rng.random((n_indices, n_steps + 1)) * ~d
+    return k, d, f, g
+
+
+# transition products are computed in chunks of max(4096, 8 * lag) steps,
+# so these lengths cover several chunks and a partial last chunk
+@pytest.mark.parametrize(
+    "lag,n_steps", [(1, 9000), (3, 4096), (3, 9000), (700, 12000)]
+)
+@pytest.mark.parametrize("n_indices", [1, 2, 3, 5])
+@pytest.mark.parametrize("function", ["array", 0.0, 1.0])
+@pytest.mark.parametrize(
+    "func,reference",
+    [
+        (_forward_transitions, forward_reference),
+        (_backward_transitions, backward_reference),
+    ],
+)
+def test_transitions(func, reference, function, n_indices, lag, n_steps):
+    k, d, f, g = transitions(n_indices, n_steps, n_indices * lag)
+    if function != "array":
+        f = function
+    expected = reference(k, d, f, g, lag)
+    out = func(k, d, f, g, lag)
+    assert out.shape == (n_indices + 1, n_indices + 1, n_steps - lag + 1)
+    assert out.flags.c_contiguous
+    np.testing.assert_allclose(out, expected, rtol=1e-10, atol=1e-12)
+    out = func(k, d, f, g, lag, parallel=False)
+    np.testing.assert_allclose(out, expected, rtol=1e-10, atol=1e-12)